@@ -6,12 +6,28 @@ import time
 
 import boto3
 import dateutil.parser
+from botocore.exceptions import ClientError
 
 logging.getLogger().setLevel(logging.INFO)
 logger = logging.getLogger()
 
 DDB_TABLE_NAME = "TrustedAdvisorCheckTrackerTable"
 
+# Container-level table, created on first use and reused across invocations
+_table = None
+
+
+def _get_table():
+    """
+    Get the TrustedAdvisorCheckTrackerTable DDB table, creating it on first use
+
+    :return: boto3 DynamoDB Table resource
+    """
+    global _table
+    if _table is None:
+        _table = boto3.resource("dynamodb").Table(DDB_TABLE_NAME)
+    return _table
+
 
 def convert_to_epoch(datetime_str):
     return int(time.mktime(dateutil.parser.parse(datetime_str).timetuple()))
@@ -33,37 +49,11 @@ def lambda_handler(event, context):
         (check_name + resource + region).encode("utf-8")
     ).hexdigest()
 
-    dynamodb = boto3.resource("dynamodb")
-    table = dynamodb.Table(DDB_TABLE_NAME)
-
-    # Check if the item already exists in the table
-    existing_item = table.get_item(Key={"hashKey": hash_key, "resource": resource}).get(
-        "Item"
-    )
-
-    if existing_item:
-        existing_time_epoch = existing_item.get("lastUpdatedTimeEpoch")
-
-        # Update the existing item with new values. Only if the check update is more recent than
-        # what is recorded in the DDB TrustedAdvisorCheckTrackerTable
-        if last_updated_time_epoch > existing_time_epoch:
-            table.put_item(
-                Item={
-                    "hashKey": hash_key,
-                    "checkName": check_name,
-                    "resourceStatus": status,
-                    "lastUpdatedTime": last_updated_time_str,
-                    "lastUpdatedTimeEpoch": last_updated_time_epoch,
-                    "resource": resource,
-                    "region": region,
-                }
-            )
-        else:
-            logger.info(
-                f"Skipping update for {hash_key}/{check_name} as the existing time is more recent."
-            )
-    else:
-        # Create a new item in the table
+    table = _get_table()
+
+    # Create the item, or update the existing item with new values. Only if the check update is more recent than
+    # what is recorded in the DDB TrustedAdvisorCheckTrackerTable
+    try:
         table.put_item(
             Item={
                 "hashKey": hash_key,
@@ -73,7 +63,15 @@ def lambda_handler(event, context):
                 "lastUpdatedTimeEpoch": last_updated_time_epoch,
                 "resource": resource,
                 "region": region,
-            }
+            },
+            ConditionExpression="attribute_not_exists(hashKey) OR lastUpdatedTimeEpoch < :new",
+            ExpressionAttributeValues={":new": last_updated_time_epoch},
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        logger.info(
+            f"Skipping update for {hash_key}/{check_name} as the existing time is more recent."
         )
 
     return
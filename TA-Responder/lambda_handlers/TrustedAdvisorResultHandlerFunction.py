@@ -1,12 +1,18 @@
 """TrustedAdvisorResultHandler - Lambda function ingesting events from the DDB TrustedAdvisorCheckTrackerTable event stream. This function has the logic for creating OpsItems and executing SSM Automation Documents (if mapping configuration is in place)"""
 
+import functools
 import json
 import logging
 import os
 import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
-from botocore.exceptions import ClientError
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
 
 logging.getLogger().setLevel(logging.INFO)
 logger = logging.getLogger()
@@ -20,28 +26,139 @@ AUTOMATION_DOCUMENT_INVOKE_MODEL_ROLE = os.environ[
 GEN_AI_RECOMMENDATIONS_ENABLED = (
     os.environ["GEN_AI_RECOMMENDATIONS_ENABLED"].lower() == "true"
 )
+# Number of stream records processed concurrently
+MAX_WORKERS = int(os.environ.get("MAX_WORKERS", "10"))
+# Seconds the AutomationMappingTable items are cached for
+MAPPING_CACHE_TTL_SECS = int(os.environ.get("MAPPING_CACHE_TTL_SECS", "300"))
+# Seconds before a failed load of the AutomationMappingTable items is retried
+MAPPING_RETRY_SECS = 30
+# Maximum number of ARNs in the ResourceARNList of a GetResources call
+TAGGING_BATCH_SIZE = 100
+# Error codes for which a stream record is reported as failed and retried
+RETRYABLE_ERROR_CODES = (
+    "InternalServerError",
+    "ServiceUnavailable",
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "RequestLimitExceeded",
+)
+
+# Container-level registry of clients and tables, reused across invocations
+_session = None
+_clients = {}
+_tables = {}
+_registry_lock = threading.Lock()
+
+
+def _get_client(service, region=None):
+    """
+    Get the client of a service in a region from the container-level registry. Clients are created on first use, reused for the life of the container and shared by the worker threads, with a connection pool of MAX_WORKERS connections
+
+    :param service: AWS service name
+    :param region: AWS region. Defaults to the region of the Lambda function
+    :return: boto3 client
+    """
+    global _session
+    key = (service, region or os.environ["AWS_REGION"])
+    with _registry_lock:
+        if key not in _clients:
+            if _session is None:
+                _session = boto3.session.Session()
+            _clients[key] = _session.client(
+                service,
+                region_name=key[1],
+                config=Config(max_pool_connections=MAX_WORKERS),
+            )
+        return _clients[key]
+
+
+def _get_table(table_name):
+    """
+    Get a DDB table from the container-level registry. Only item actions are used on it, which are safe to share between worker threads as they go through the table's client
+
+    :param table_name: Name of the DDB table
+    :return: boto3 DynamoDB Table resource
+    """
+    global _session
+    with _registry_lock:
+        if table_name not in _tables:
+            if _session is None:
+                _session = boto3.session.Session()
+            dynamodb = _session.resource(
+                "dynamodb", config=Config(max_pool_connections=MAX_WORKERS)
+            )
+            _tables[table_name] = dynamodb.Table(table_name)
+        return _tables[table_name]
 
 
-def _replace_resource_id(automation_parameters, resource_id):
+# Container-level cache of the AutomationMappingTable items, keyed by check name
+_mapping_items = None
+_mapping_expiry = 0
+_mapping_lock = threading.Lock()
+
+
+def _find_resource_id_slots(automation_parameters, path=()):
     """
-    Replace any instance of '$resourceId' in the 'automation_parameters' object with the value of 'resource_id'
+    Find the paths of the strings with instances of '$resourceId' in the 'automation_parameters' object
 
     :param automation_parameters: The automation parameters object with instances of the '$resourceId' variable
-    :param resource_id: The resource ID to include in the automation parameters object
-    :return: The modified automation parameters object
+    :param path: Path of the 'automation_parameters' object from the root of the template
+    :return: List of (path, fragments) tuples, where fragments are the parts of the string around '$resourceId'
     """
     if isinstance(automation_parameters, dict):
-        for key, value in automation_parameters.items():
-            if isinstance(value, str):
-                automation_parameters[key] = value.replace("$resourceId", resource_id)
-            elif isinstance(value, (dict, list)):
-                automation_parameters[key] = _replace_resource_id(value, resource_id)
+        items = automation_parameters.items()
     elif isinstance(automation_parameters, list):
-        for i, item in enumerate(automation_parameters):
-            if isinstance(item, str):
-                automation_parameters[i] = item.replace("$resourceId", resource_id)
-            elif isinstance(item, (dict, list)):
-                automation_parameters[i] = _replace_resource_id(item, resource_id)
+        items = enumerate(automation_parameters)
+    elif (
+        isinstance(automation_parameters, str)
+        and "$resourceId" in automation_parameters
+    ):
+        return [(path, automation_parameters.split("$resourceId"))]
+    else:
+        return []
+
+    slots = []
+    for key, value in items:
+        slots.extend(_find_resource_id_slots(value, path + (key,)))
+    return slots
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_mapping(regex_pattern, automation_parameters):
+    """
+    Compile the regex pattern and parse the automation parameters template of a mapping item. Results are cached by the raw values, so an updated mapping item is compiled again.
+
+    :param regex_pattern: Regex pattern to extract the resource ID from the resource ARN
+    :param automation_parameters: Automation parameters template, as a JSON string
+    :return: Tuple of compiled regex pattern, parsed template and '$resourceId' slots
+    """
+    template = json.loads(automation_parameters)
+    return re.compile(regex_pattern), template, _find_resource_id_slots(template)
+
+
+def _render_automation_parameters(template, slots, resource_id):
+    """
+    Replace the '$resourceId' slots of a parsed template with 'resource_id'. Only the containers on the path of a slot are copied, the rest is shared with the template.
+
+    :param template: Parsed automation parameters template
+    :param slots: List of (path, fragments) tuples of the template
+    :param resource_id: The resource ID to include in the automation parameters object
+    :return: The automation parameters object
+    """
+    automation_parameters = (
+        dict(template) if isinstance(template, dict) else list(template)
+    )
+    copies = {(): automation_parameters}
+    for path, fragments in slots:
+        node = automation_parameters
+        for depth in range(1, len(path)):
+            prefix = path[:depth]
+            if prefix not in copies:
+                child = node[path[depth - 1]]
+                copies[prefix] = dict(child) if isinstance(child, dict) else list(child)
+                node[path[depth - 1]] = copies[prefix]
+            node = copies[prefix]
+        node[path[-1]] = resource_id.join(fragments)
     return automation_parameters
 
 
@@ -52,10 +169,10 @@ def _create_ops_item(check_name, resource_arn, operational_data):
     :param check_name: Name of the Trusted Advisor check
     :param resource_arn: ARN of the resource
     :param operational_data: Operational data for the OpsItem
-    :return: OpsItem ID if successful, None otherwise
+    :return: OpsItem ID if successful, None otherwise. Raises the error if it is worth retrying
     """
     try:
-        ssm_ops_item_client = boto3.client("ssm")
+        ssm_ops_item_client = _get_client("ssm")
         ops_item = ssm_ops_item_client.create_ops_item(
             Description=f"{check_name}: {resource_arn}",
             OperationalData=operational_data,
@@ -65,60 +182,71 @@ def _create_ops_item(check_name, resource_arn, operational_data):
         ops_item_id = ops_item["OpsItemId"]
         logger.info(f"OpsItem {ops_item_id} created for resource {resource_arn}")
 
-    except Exception as e:
+    except ClientError as e:
         # Check if the error is OpsItemAlreadyExistsException
         if e.response["Error"]["Code"] == "OpsItemAlreadyExistsException":
             ops_item_id = e.response["OpsItemId"]
             logger.info(f"OpsItem {ops_item_id} already exists for {resource_arn}")
         else:
             logger.error(f"Error creating OpsItem for resource {resource_arn}: {e}")
+            if e.response["Error"]["Code"] in RETRYABLE_ERROR_CODES:
+                raise
             return None
 
+    except BotoCoreError as e:
+        logger.error(f"Error creating OpsItem for resource {resource_arn}: {e}")
+        raise
+
     return ops_item_id
 
 
-def _put_item_in_automation_execution_ddb(automation_execution_id, ops_item_id, region):
+def _put_items_in_automation_execution_ddb(automation_execution_items):
     """
-    Create item in AutomationExecutionTrackerTable DDB table with the OpsItem Id and SSM Automation Document execution Id.
+    Create items in AutomationExecutionTrackerTable DDB table with the OpsItem Id and SSM Automation Document execution Id.
     This allows SSMAutomationExecutionEventsHandler Lambda function to track the execution of the SSM Automation Document and update the corresponding OpsItem.
+    The items are written with BatchWriteItem requests of up to 25 items, and unprocessed items are resent by the batch writer.
 
-    :param automation_execution_id: SSM Automation Document execution Id
-    :param ops_item_id: OpsItem Id
-    :param region: AWS region
-    :return: None
+    :param automation_execution_items: List of items with the automationExecutionId, opsItemId and region attributes
+    :return: True if the items were written, False otherwise
     """
+    if not automation_execution_items:
+        return True
+
     try:
-        dynamodb = boto3.resource("dynamodb")
-        automation_execution_table = dynamodb.Table(
+        automation_execution_table = _get_table(
             AUTOMATION_EXECUTION_TRACKER_DDB_TABLE_NAME
         )
-        automation_execution_table.put_item(
-            Item={
-                "automationExecutionId": automation_execution_id,
-                "opsItemId": ops_item_id,
-                "region": region,
-            }
-        )
+        with automation_execution_table.batch_writer() as batch:
+            for item in automation_execution_items:
+                batch.put_item(Item=item)
 
-    except ClientError as e:
+    except (BotoCoreError, ClientError) as e:
         logger.error(
-            f"Error adding item to DDB AutomationExecutionTrackerTable for execution {automation_execution_id} and OpsItem {ops_item_id}: {e}"
+            f"Error adding items to DDB AutomationExecutionTrackerTable for executions {[item['automationExecutionId'] for item in automation_execution_items]}: {e}"
         )
+        return False
 
+    return True
 
-def _start_automation_execution(document_name, automation_parameters, region):
+
+def _start_automation_execution(
+    document_name, automation_parameters, region, client_token
+):
     """
     Start an SSM automation execution based on the provided document name and parameters.
 
     :param document_name: Name of the SSM automation document
     :param automation_parameters: Parameters for the SSM automation execution
     :param region: AWS region
-    :return: Automation execution ID, or None if an error occurred
+    :param client_token: Idempotency token, so a retried record does not start the automation again
+    :return: Automation execution ID, or None if an error occurred. Raises the error if it is worth retrying
     """
     try:
-        ssm_document_execution_client = boto3.client("ssm", region_name=region)
+        ssm_document_execution_client = _get_client("ssm", region)
         automation_execution = ssm_document_execution_client.start_automation_execution(
-            DocumentName=document_name, Parameters=automation_parameters
+            DocumentName=document_name,
+            Parameters=automation_parameters,
+            ClientToken=client_token,
         )
 
         automation_execution_id = automation_execution["AutomationExecutionId"]
@@ -127,11 +255,59 @@ def _start_automation_execution(document_name, automation_parameters, region):
 
     except ClientError as e:
         logger.error(f"Error starting the automation execution: {e}")
+        if e.response["Error"]["Code"] in RETRYABLE_ERROR_CODES:
+            raise
         return None
 
+    except BotoCoreError as e:
+        logger.error(f"Error starting the automation execution: {e}")
+        raise
+
     return automation_execution_id
 
 
+def _get_ddb_mapping_items():
+    """
+    Get all the items of the AutomationMappingTable DDB table, keyed by check name. The table is scanned once and cached for MAPPING_CACHE_TTL_SECS seconds.
+    If the scan fails, the previously cached items are kept and the scan is retried after MAPPING_RETRY_SECS seconds. If no items were cached yet, the error is raised.
+
+    :return: Dictionary of mapping items by check name
+    """
+    global _mapping_items, _mapping_expiry
+    with _mapping_lock:
+        if time.time() < _mapping_expiry:
+            return _mapping_items
+
+        try:
+            automation_mapping_table = _get_table(AUTOMATION_MAPPING_DDB_TABLE_NAME)
+            scan_kwargs = {}
+            mapping_items = {}
+            while True:
+                scan_response = automation_mapping_table.scan(**scan_kwargs)
+                for item in scan_response["Items"]:
+                    mapping_items[item["checkName"]] = item
+                if "LastEvaluatedKey" not in scan_response:
+                    break
+                scan_kwargs["ExclusiveStartKey"] = scan_response["LastEvaluatedKey"]
+
+            _mapping_items = mapping_items
+            _mapping_expiry = time.time() + MAPPING_CACHE_TTL_SECS
+            logger.info(
+                f"Loaded {len(mapping_items)} mapping items from DDB AutomationMappingTable"
+            )
+
+        except (BotoCoreError, ClientError) as e:
+            logger.warning(
+                f"Error retrieving mapping items from DDB AutomationMappingTable: {e}"
+            )
+            # Without a cache every record would be handled as unmapped
+            if _mapping_items is None:
+                raise
+            _mapping_expiry = time.time() + MAPPING_RETRY_SECS
+
+        return _mapping_items
+
+
 def _get_ddb_mapping_item(check_name):
     """
     Retrieve the mapping item from the AutomationMappingTable DDB table based on the check name.
@@ -154,26 +330,12 @@ def _get_ddb_mapping_item(check_name):
         }
     }
 
+    The items are served from a container-level cache, so checks without a mapping are cached as well.
+
     :param check_name: Name of the Trusted Advisor check
     :return: Mapping item from the DDB table, or None if not found
     """
-    try:
-        dynamodb = boto3.resource("dynamodb")
-        automation_mapping_table = dynamodb.Table(AUTOMATION_MAPPING_DDB_TABLE_NAME)
-        get_item_response = automation_mapping_table.get_item(
-            Key={"checkName": check_name}
-        )
-        mapping_item = (
-            get_item_response["Item"] if "Item" in get_item_response else None
-        )
-
-    except ClientError as e:
-        logger.warning(
-            f"Error retrieving mapping item from DDB AutomationMappingTable for check {check_name}: {e}"
-        )
-        return None
-
-    return mapping_item
+    return _get_ddb_mapping_items().get(check_name)
 
 
 def _build_execution_automation_parameters(mapping_item, resource_arn):
@@ -185,12 +347,15 @@ def _build_execution_automation_parameters(mapping_item, resource_arn):
     :return: Automation parameters in the required format
     """
     regex_pattern = mapping_item.get("regexPattern", "")
-    match = re.search(regex_pattern, resource_arn)
+    regex, template, slots = _compile_mapping(
+        regex_pattern, mapping_item["automationParameters"]
+    )
+    match = regex.search(resource_arn)
     resource_id = match.group()
 
     if len(resource_id) > 0:
-        automation_parameters = _replace_resource_id(
-            json.loads(mapping_item["automationParameters"]), resource_id
+        automation_parameters = _render_automation_parameters(
+            template, slots, resource_id
         )
     else:
         raise Exception(
@@ -200,33 +365,35 @@ def _build_execution_automation_parameters(mapping_item, resource_arn):
     return automation_parameters
 
 
-def _get_resource_tags(resource_arn, resource_region):
+def _get_resource_tags(resource_arns, resource_region):
     """
-    Get list of tags associated with the resource
+    Get the tags of a list of resources in a region, with one paginated GetResources call for each TAGGING_BATCH_SIZE resources
 
-    :param resource_arn: ARN of the resource
-    :param resource_region: Region of the resource
-    :return: List of resource tags. Example: [{'Key': 'automaticRemediation', 'Value': 'True'}]
+    :param resource_arns: List of ARNs of the resources
+    :param resource_region: Region of the resources
+    :return: Dictionary of resource tags by resource ARN. Resources of a chunk that could not be read are left out, and so are treated as untagged. Example: {'arn:aws:ec2:ap-southeast-2:012345678901:security-group/sg-example123': [{'Key': 'automaticRemediation', 'Value': 'True'}]}
     """
-    try:
-        tag_client = boto3.client(
-            "resourcegroupstaggingapi", region_name=resource_region
-        )
-        resources_paginator = tag_client.get_paginator("get_resources")
-        resource_tag_mapping_lists = resources_paginator.paginate(
-            ResourceARNList=[resource_arn]
-        ).build_full_result()["ResourceTagMappingList"]
-    except ClientError as e:
-        logger.warning(
-            f"Failed to retrieve resource tags for resource {resource_arn}. {e}"
-        )
-        return []
+    resource_tags = {}
+    for i in range(0, len(resource_arns), TAGGING_BATCH_SIZE):
+        resource_arns_batch = resource_arns[i : i + TAGGING_BATCH_SIZE]
+        try:
+            tag_client = _get_client("resourcegroupstaggingapi", resource_region)
+            resources_paginator = tag_client.get_paginator("get_resources")
+            resource_tag_mapping_lists = resources_paginator.paginate(
+                ResourceARNList=resource_arns_batch
+            ).build_full_result()["ResourceTagMappingList"]
+        except (BotoCoreError, ClientError) as e:
+            logger.warning(
+                f"Failed to retrieve resource tags for {len(resource_arns_batch)} resources in {resource_region}. {e}"
+            )
+            continue
 
-    if len(resource_tag_mapping_lists) == 0:
-        return []
-    else:
-        # Example return: [{'Key': 'automaticRemediation', 'Value': 'True'}]
-        return resource_tag_mapping_lists[0]["Tags"]
+        for resource_tag_mapping in resource_tag_mapping_lists:
+            resource_tags[resource_tag_mapping["ResourceARN"]] = resource_tag_mapping[
+                "Tags"
+            ]
+
+    return resource_tags
 
 
 def _is_resource_level_automatic_remediation_enabled(resource_tags):
@@ -246,157 +413,231 @@ def _is_resource_level_automatic_remediation_enabled(resource_tags):
         return False
 
 
-def lambda_handler(event, context):
-    for record in event["Records"]:
-        """
-        Extracting values from DDB TrustedAdvisorCheckTrackerTable stream. Example event:
-
-        {'Records': [{'eventID': 'example123id', 'eventName': 'MODIFY', 'eventVersion': '1.1', 'eventSource': 'aws:dynamodb', 'awsRegion': 'us-east-1', 'dynamodb': {'ApproximateCreationDateTime': 1715587134.0, 'Keys': {'hashKey': {'S': 'abc123xyz'}, 'resource': {'S': 'arn:aws:ec2:ap-southeast-2:012345678901:security-group/sg-example123'}}, 'NewImage': {'lastUpdatedTimeEpoch': {'N': '1715573312'}, 'hashKey': {'S': 'abc123xyz'}, 'resourceStatus': {'S': 'Red'}, 'resource': {'S': 'arn:aws:ec2:ap-southeast-2:012345678901:security-group/sg-example123'}, 'lastUpdatedTime': {'S': '2024-05-13T04:08:32.687Z'}, 'checkName': {'S': 'Security groups should not allow unrestricted access to ports with high risk'}, 'region': {'S': 'ap-southeast-2'}}, 'SequenceNumber': '10053100000000041555340248', 'SizeBytes': 498, 'StreamViewType': 'NEW_IMAGE'}, 'eventSourceARN': 'arn:aws:dynamodb:us-east-1:012345678901:table/TrustedAdvisorCheckTrackerTable/stream/2024-05-11T07:16:57.900'}]}
-        """
-        new_image = record["dynamodb"]["NewImage"]
-        check_name = new_image.get("checkName", {}).get("S")
-        resource_arn = new_image.get("resource", {}).get("S")
-        region = new_image.get("region", {}).get("S")
-        hash_key = new_image.get("hashKey", {}).get("S")
+def _process_record(record, resource_tags):
+    """
+    Create the OpsItem for one record of the DDB TrustedAdvisorCheckTrackerTable stream, and start the SSM automation execution if it is enabled for the check and the resource.
+    Example record, in a batch event:
+
+    {'Records': [{'eventID': 'example123id', 'eventName': 'MODIFY', 'eventVersion': '1.1', 'eventSource': 'aws:dynamodb', 'awsRegion': 'us-east-1', 'dynamodb': {'ApproximateCreationDateTime': 1715587134.0, 'Keys': {'hashKey': {'S': 'abc123xyz'}, 'resource': {'S': 'arn:aws:ec2:ap-southeast-2:012345678901:security-group/sg-example123'}}, 'NewImage': {'lastUpdatedTimeEpoch': {'N': '1715573312'}, 'hashKey': {'S': 'abc123xyz'}, 'resourceStatus': {'S': 'Red'}, 'resource': {'S': 'arn:aws:ec2:ap-southeast-2:012345678901:security-group/sg-example123'}, 'lastUpdatedTime': {'S': '2024-05-13T04:08:32.687Z'}, 'checkName': {'S': 'Security groups should not allow unrestricted access to ports with high risk'}, 'region': {'S': 'ap-southeast-2'}}, 'SequenceNumber': '10053100000000041555340248', 'SizeBytes': 498, 'StreamViewType': 'NEW_IMAGE'}, 'eventSourceARN': 'arn:aws:dynamodb:us-east-1:012345678901:table/TrustedAdvisorCheckTrackerTable/stream/2024-05-11T07:16:57.900'}]}
+
+    :param record: DDB stream record
+    :param resource_tags: Dictionary of resource tags by resource ARN, for the resources of the batch
+    :return: Item for the AutomationExecutionTrackerTable DDB table if an automation execution was started, None otherwise. Raises an exception if the automation execution or the OpsItem could not be started or created because of an error worth retrying, so the record is reported as a batch item failure and retried
+    """
+    new_image = record["dynamodb"]["NewImage"]
+    check_name = new_image.get("checkName", {}).get("S")
+    resource_arn = new_image.get("resource", {}).get("S")
+    region = new_image.get("region", {}).get("S")
+    hash_key = new_image.get("hashKey", {}).get("S")
 
-        # Avoid duplicate OpsItem creation.
-        dedup_value = {"dedupString": hash_key}
+    # Avoid duplicate OpsItem creation.
+    dedup_value = {"dedupString": hash_key}
 
-        resource_tags = _get_resource_tags(resource_arn, region)
+    mapping_item = _get_ddb_mapping_item(check_name)
 
-        mapping_item = _get_ddb_mapping_item(check_name)
+    # Verifies if automation is enabled at resource tag level
+    resource_level_remediation_flag = _is_resource_level_automatic_remediation_enabled(
+        resource_tags.get(resource_arn, [])
+    )
+
+    # Verifies if automation is enabled at global level in the DDB AutomationMappingTable
+    # 'False' if either 'mapping_item' is None, or, if mapping_item.automationStatus is 'false'
+    global_level_remediation_flag = (
+        mapping_item.get("automationStatus", False) if mapping_item else False
+    )
+
+    # If automation mapping is not found in AutomationMappingTable DDB table, or, automation is not enabled at resource tag level,
+    # create the OpsItem without any automation execution
+    if not global_level_remediation_flag or not resource_level_remediation_flag:
+        if GEN_AI_RECOMMENDATIONS_ENABLED:
+            invoke_model_url = f"https://{os.environ['AWS_REGION']}.console.aws.amazon.com/systems-manager/automation/execute/taResponderAutomationDocumentInvokeModel?region={os.environ['AWS_REGION']}#AutomationAssumeRole={AUTOMATION_DOCUMENT_INVOKE_MODEL_ROLE}&CheckName={check_name}&AffectedResourceArn={resource_arn}"
+            operational_data = {
+                "flaggedResource": {
+                    "Value": resource_arn,
+                    "Type": "SearchableString",
+                },
+                "/aws/automations": {
+                    "Type": "SearchableString",
+                    "Value": f'[{{"automationType": "AWS::SSM::Automation", "automationId": "{AUTOMATION_DOCUMENT_INVOKE_MODEL}"}}]',
+                },
+                "invokeModelParameters": {
+                    "Type": "String",
+                    "Value": json.dumps(
+                        {
+                            "AutomationAssumeRole": AUTOMATION_DOCUMENT_INVOKE_MODEL_ROLE,
+                            "AffectedResourceArn": resource_arn,
+                            "CheckName": check_name,
+                        }
+                    ),
+                },
+                "invokeModelUrl": {"Value": invoke_model_url, "Type": "String"},
+                "/aws/dedup": {
+                    "Value": json.dumps(dedup_value),
+                    "Type": "SearchableString",
+                },
+            }
+        else:
+            operational_data = {
+                "flaggedResource": {
+                    "Value": resource_arn,
+                    "Type": "SearchableString",
+                },
+                "/aws/dedup": {
+                    "Value": json.dumps(dedup_value),
+                    "Type": "SearchableString",
+                },
+            }
 
-        # Verifies if automation is enabled at resource tag level
-        resource_level_remediation_flag = (
-            _is_resource_level_automatic_remediation_enabled(resource_tags)
+        # Create the OpsItem
+        _create_ops_item(check_name, resource_arn, operational_data)
+
+    # Create the OpsItem and start the automation execution only if
+    # the automation is enabled at resource tag level and global (AutomationMappingTable DDB table) level
+    elif global_level_remediation_flag and resource_level_remediation_flag:
+        if GEN_AI_RECOMMENDATIONS_ENABLED:
+            invoke_model_url = f"https://{os.environ['AWS_REGION']}.console.aws.amazon.com/systems-manager/automation/execute/taResponderAutomationDocumentInvokeModel?region={os.environ['AWS_REGION']}#AutomationAssumeRole={AUTOMATION_DOCUMENT_INVOKE_MODEL_ROLE}&CheckName={check_name}&AffectedResourceArn={resource_arn}"
+            operational_data = {
+                "flaggedResource": {
+                    "Value": resource_arn,
+                    "Type": "SearchableString",
+                },
+                "/aws/automations": {
+                    "Type": "SearchableString",
+                    "Value": f"[{{\"automationType\": \"AWS::SSM::Automation\", \"automationId\": \"{mapping_item['ssmAutomationDocument']}\"}}, {{\"automationType\": \"AWS::SSM::Automation\", \"automationId\": \"{AUTOMATION_DOCUMENT_INVOKE_MODEL}\"}}]",
+                },
+                "automationParameters": {
+                    "Type": "String",
+                    "Value": json.dumps(mapping_item["automationParameters"]),
+                },
+                "invokeModelParameters": {
+                    "Type": "String",
+                    "Value": json.dumps(
+                        {
+                            "AutomationAssumeRole": AUTOMATION_DOCUMENT_INVOKE_MODEL_ROLE,
+                            "AffectedResourceArn": resource_arn,
+                            "CheckName": check_name,
+                        }
+                    ),
+                },
+                "invokeModelUrl": {"Value": invoke_model_url, "Type": "String"},
+                "/aws/dedup": {
+                    "Value": json.dumps(dedup_value),
+                    "Type": "SearchableString",
+                },
+            }
+        else:
+            operational_data = {
+                "flaggedResource": {
+                    "Value": resource_arn,
+                    "Type": "SearchableString",
+                },
+                "/aws/automations": {
+                    "Type": "SearchableString",
+                    "Value": f"[{{\"automationType\": \"AWS::SSM::Automation\", \"automationId\": \"{mapping_item['ssmAutomationDocument']}\"}}]",
+                },
+                "automationParameters": {
+                    "Type": "String",
+                    "Value": json.dumps(mapping_item["automationParameters"]),
+                },
+                "/aws/dedup": {
+                    "Value": json.dumps(dedup_value),
+                    "Type": "SearchableString",
+                },
+            }
+
+        automation_parameters = _build_execution_automation_parameters(
+            mapping_item, resource_arn
         )
 
-        # Verifies if automation is enabled at global level in the DDB AutomationMappingTable
-        # 'False' if either 'mapping_item' is None, or, if mapping_item.automationStatus is 'false'
-        global_level_remediation_flag = (
-            mapping_item.get("automationStatus", False) if mapping_item else False
+        operational_data["automationParameters"]["Value"] = json.dumps(
+            automation_parameters
         )
 
-        # If automation mapping is not found in AutomationMappingTable DDB table, or, automation is not enabled at resource tag level,
-        # create the OpsItem without any automation execution
-        if not global_level_remediation_flag or not resource_level_remediation_flag:
-            if GEN_AI_RECOMMENDATIONS_ENABLED:
-                invoke_model_url = f"https://{os.environ['AWS_REGION']}.console.aws.amazon.com/systems-manager/automation/execute/taResponderAutomationDocumentInvokeModel?region={os.environ['AWS_REGION']}#AutomationAssumeRole={AUTOMATION_DOCUMENT_INVOKE_MODEL_ROLE}&CheckName={check_name}&AffectedResourceArn={resource_arn}"
-                operational_data = {
-                    "flaggedResource": {
-                        "Value": resource_arn,
-                        "Type": "SearchableString",
-                    },
-                    "/aws/automations": {
-                        "Type": "SearchableString",
-                        "Value": f'[{{"automationType": "AWS::SSM::Automation", "automationId": "{AUTOMATION_DOCUMENT_INVOKE_MODEL}"}}]',
-                    },
-                    "invokeModelParameters": {
-                        "Type": "String",
-                        "Value": json.dumps(
-                            {
-                                "AutomationAssumeRole": AUTOMATION_DOCUMENT_INVOKE_MODEL_ROLE,
-                                "AffectedResourceArn": resource_arn,
-                                "CheckName": check_name,
-                            }
-                        ),
-                    },
-                    "invokeModelUrl": {"Value": invoke_model_url, "Type": "String"},
-                    "/aws/dedup": {
-                        "Value": json.dumps(dedup_value),
-                        "Type": "SearchableString",
-                    },
-                }
-            else:
-                operational_data = {
-                    "flaggedResource": {
-                        "Value": resource_arn,
-                        "Type": "SearchableString",
-                    },
-                    "/aws/dedup": {
-                        "Value": json.dumps(dedup_value),
-                        "Type": "SearchableString",
-                    },
-                }
-
-            # Create the OpsItem
-            ops_item_id = _create_ops_item(check_name, resource_arn, operational_data)
-            return
-
-        # Create the OpsItem and start the automation execution only if
-        # the automation is enabled at resource tag level and global (AutomationMappingTable DDB table) level
-        elif global_level_remediation_flag and resource_level_remediation_flag:
-            if GEN_AI_RECOMMENDATIONS_ENABLED:
-                invoke_model_url = f"https://{os.environ['AWS_REGION']}.console.aws.amazon.com/systems-manager/automation/execute/taResponderAutomationDocumentInvokeModel?region={os.environ['AWS_REGION']}#AutomationAssumeRole={AUTOMATION_DOCUMENT_INVOKE_MODEL_ROLE}&CheckName={check_name}&AffectedResourceArn={resource_arn}"
-                operational_data = {
-                    "flaggedResource": {
-                        "Value": resource_arn,
-                        "Type": "SearchableString",
-                    },
-                    "/aws/automations": {
-                        "Type": "SearchableString",
-                        "Value": f"[{{\"automationType\": \"AWS::SSM::Automation\", \"automationId\": \"{mapping_item['ssmAutomationDocument']}\"}}, {{\"automationType\": \"AWS::SSM::Automation\", \"automationId\": \"{AUTOMATION_DOCUMENT_INVOKE_MODEL}\"}}]",
-                    },
-                    "automationParameters": {
-                        "Type": "String",
-                        "Value": json.dumps(mapping_item["automationParameters"]),
-                    },
-                    "invokeModelParameters": {
-                        "Type": "String",
-                        "Value": json.dumps(
-                            {
-                                "AutomationAssumeRole": AUTOMATION_DOCUMENT_INVOKE_MODEL_ROLE,
-                                "AffectedResourceArn": resource_arn,
-                                "CheckName": check_name,
-                            }
-                        ),
-                    },
-                    "invokeModelUrl": {"Value": invoke_model_url, "Type": "String"},
-                    "/aws/dedup": {
-                        "Value": json.dumps(dedup_value),
-                        "Type": "SearchableString",
-                    },
-                }
-            else:
-                operational_data = {
-                    "flaggedResource": {
-                        "Value": resource_arn,
-                        "Type": "SearchableString",
-                    },
-                    "/aws/automations": {
-                        "Type": "SearchableString",
-                        "Value": f"[{{\"automationType\": \"AWS::SSM::Automation\", \"automationId\": \"{mapping_item['ssmAutomationDocument']}\"}}]",
-                    },
-                    "automationParameters": {
-                        "Type": "String",
-                        "Value": json.dumps(mapping_item["automationParameters"]),
-                    },
-                    "/aws/dedup": {
-                        "Value": json.dumps(dedup_value),
-                        "Type": "SearchableString",
-                    },
-                }
-
-            automation_parameters = _build_execution_automation_parameters(
-                mapping_item, resource_arn
-            )
+        # Start automation execution. The token is derived from the stream record, so a retry of the record reuses it
+        automation_execution_id = _start_automation_execution(
+            mapping_item["ssmAutomationDocument"],
+            automation_parameters,
+            region,
+            str(uuid.uuid5(uuid.NAMESPACE_URL, record["eventID"])),
+        )
 
-            operational_data["automationParameters"]["Value"] = json.dumps(
-                automation_parameters
-            )
+        # Create the OpsItem
+        ops_item_id = _create_ops_item(check_name, resource_arn, operational_data)
 
-            # Start automation execution
-            automation_execution_id = _start_automation_execution(
-                mapping_item["ssmAutomationDocument"], automation_parameters, region
-            )
+        # Item for AutomationExecutionTrackerTable DDB table with OpsItem and Execution Ids, written at the end of the batch
+        if automation_execution_id and ops_item_id:
+            return {
+                "automationExecutionId": automation_execution_id,
+                "opsItemId": ops_item_id,
+                "region": region,
+            }
+
+    return None
 
-            # Create the OpsItem
-            ops_item_id = _create_ops_item(check_name, resource_arn, operational_data)
 
-            # Create item in AutomationExecutionTrackerTable DDB table with OpsItem and Execution Ids
-            if automation_execution_id and ops_item_id:
-                _put_item_in_automation_execution_ddb(
-                    automation_execution_id, ops_item_id, region
-                )
+def lambda_handler(event, context):
+    """
+    Process the records of a DDB TrustedAdvisorCheckTrackerTable stream batch concurrently, with up to MAX_WORKERS threads, then write the started automation executions to the AutomationExecutionTrackerTable DDB table.
+
+    :param event: DDB stream event with a batch of records
+    :param context: Lambda context
+    :return: Records that failed with an error worth retrying, reported as batchItemFailures so only those are retried. Records that failed with any other error are logged and skipped
+    """
+    records = event["Records"]
+    batch_item_failures = []
+    automation_execution_items = []
+    automation_execution_records = []
+
+    # Load the mapping before the records are processed. If it cannot be read, the whole batch fails and is retried
+    _get_ddb_mapping_items()
+
+    # Fetch the tags of all the resources of the batch, grouped by region
+    resource_arns_by_region = {}
+    for record in records:
+        new_image = record["dynamodb"].get("NewImage", {})
+        resource_arn = new_image.get("resource", {}).get("S")
+        if resource_arn:
+            region = new_image.get("region", {}).get("S")
+            resource_arns_by_region.setdefault(region, set()).add(resource_arn)
+
+    resource_tags = {}
+    for region, resource_arns in resource_arns_by_region.items():
+        resource_tags.update(_get_resource_tags(sorted(resource_arns), region))
+
+    with ThreadPoolExecutor(
+        max_workers=max(1, min(MAX_WORKERS, len(records)))
+    ) as executor:
+        futures = [
+            (record, executor.submit(_process_record, record, resource_tags))
+            for record in records
+        ]
+
+    for record, future in futures:
+        try:
+            automation_execution_item = future.result()
+            if automation_execution_item:
+                automation_execution_items.append(automation_execution_item)
+                automation_execution_records.append(record)
+        except (BotoCoreError, ClientError) as e:
+            logger.error(f"Error processing record {record['eventID']}: {e}")
+            if (
+                isinstance(e, ClientError)
+                and e.response["Error"]["Code"] not in RETRYABLE_ERROR_CODES
+            ):
+                continue
+            batch_item_failures.append(
+                {"itemIdentifier": record["dynamodb"]["SequenceNumber"]}
+            )
+        except Exception as e:
+            # A retry would fail the same way, e.g. a malformed mapping or record
+            logger.error(f"Error processing record {record['eventID']}, skipped: {e}")
+
+    # Write the OpsItem and Execution Ids of the batch before the invocation ends. If the write fails, their records
+    # are retried: the automation execution is not started again, its idempotency token returns the same execution Id
+    if not _put_items_in_automation_execution_ddb(automation_execution_items):
+        batch_item_failures.extend(
+            {"itemIdentifier": record["dynamodb"]["SequenceNumber"]}
+            for record in automation_execution_records
+        )
 
-    return
+    return {"batchItemFailures": batch_item_failures}
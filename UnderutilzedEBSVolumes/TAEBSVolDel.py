@@ -16,15 +16,26 @@ limitations under the License.
 # attached within the threshold period it will snapshot the volume and
 # delete it.
 
+import time
+INIT_START = time.perf_counter() # for the cold start timing breakdown
+
 import os
+import io
 import json
+import random
 import re
-import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial, wraps
 from datetime import datetime, timedelta
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
 client = {} # dict to save client object for future invocations
+sessions = {} # boto3 session per region. Clients are thread safe, sessions are not
+client_lock = threading.Lock()
 
 def getLambdaEnv(parmname, defaultval=None):
     """
@@ -32,8 +43,8 @@ def getLambdaEnv(parmname, defaultval=None):
     """
     try:
         myval = os.environ[parmname]
-        if isinstance(defaultval, int):
-            return int(myval)
+        if isinstance(defaultval, (int, float)):
+            return type(defaultval)(myval)
         else:
             return myval
     except:
@@ -44,80 +55,533 @@ def getLambdaEnv(parmname, defaultval=None):
             print('ERROR: Environmental variable \'' + parmname + '\' not found. Exiting')
             raise
 
-IDLETHRESH = getLambdaEnv('IdleThresh', 90) # number of days unattached allowed
-EXCEPTTAG = getLambdaEnv('IgnoreTag', 'ignoreEBSidle')       # ignore volumes with this tag
-EXCEPTTAGVAL = getLambdaEnv('IgnoreTagVal', 'False') # value to ignore if present
-MAILTOOWNER = getLambdaEnv('MailtoOwnerTag', 'Owner') # name of the tag containing owner email
-MAILTO = getLambdaEnv('MailTo', 'miobrien@amazon.com')             # email to notify (with or without MAILTOOWNER)
-GOLIVE = getLambdaEnv('EnableActions', 'False') # Do not enable actions unless explicitely set
-FROM_EMAIL = getLambdaEnv('FromEmail', 'miobrien@amazon.com') # Email address to send from
+#======================================================================
+#
+class LambdaConfig:
+    """
+    Lambda configuration, read from the environment on first use so nothing
+    is read or called at import time. The account id is taken from the
+    invocation (see set_account); STS is only called if that is not possible.
+    """
+    ENV = {
+        'IDLETHRESH': ('IdleThresh', 90), # number of days unattached allowed
+        'EXCEPTTAG': ('IgnoreTag', 'ignoreEBSidle'), # ignore volumes with this tag
+        'EXCEPTTAGVAL': ('IgnoreTagVal', 'False'), # value to ignore if present
+        'MAILTOOWNER': ('MailtoOwnerTag', 'Owner'), # name of the tag containing owner email
+        'MAILTO': ('MailTo', 'miobrien@amazon.com'), # email to notify (with or without MAILTOOWNER)
+        'GOLIVE': ('EnableActions', 'False'), # Do not enable actions unless explicitely set
+        'FROM_EMAIL': ('FromEmail', 'miobrien@amazon.com'), # Email address to send from
+        'SESSENDRATE': ('SesSendRate', 1.0), # SES maximum send rate (emails per second)
+        'REGIONWORKERS': ('RegionWorkers', 8), # regions swept in parallel
+        'REGIONCONCURRENCY': ('RegionConcurrency', 4), # parallel calls per region during a sweep
+        'STATEBUCKET': ('StateBucket', ''), # S3 bucket to persist state in (optional)
+        'SNAPSHOTQUEUE': ('SnapshotQueueArn', ''), # SQS queue buffering snapshot completions (optional)
+        'IGNOREVOLUMES': ('IgnoreVolumes', ''), # comma separated volume ids never to act on (optional)
+        'MINMONTHLYCOST': ('MinMonthlyCost', ''), # ignore volumes costing less than this per month (optional)
+        'CANDIDATETABLE': ('CandidateTable', ''), # DynamoDB table queueing volumes by monthly cost (optional)
+        'APIBUDGET': ('ApiBudget', ''), # max AWS API calls per drain of the candidate table (optional)
+        'SNAPSHOTCONCURRENCY': ('SnapshotConcurrency', 50), # max idle volume snapshots pending per region
+    }
+
+    def __init__(self):
+        self._account = None
+        self._ignorevolumes = None
+
+    def __getattr__(self, name):
+        if name not in LambdaConfig.ENV:
+            raise AttributeError(name)
+        start = time.perf_counter()
+        parmname, defaultval = LambdaConfig.ENV[name]
+        if defaultval == '':
+            value = os.environ.get(parmname, '')
+        else:
+            value = getLambdaEnv(parmname, defaultval)
+        setattr(self, name, value)
+        STARTUP['config_ms'] += (time.perf_counter() - start) * 1000
+        return value
+
+    @property
+    def ignorevolumes(self):
+        """
+        Set of volume ids from IGNOREVOLUMES, parsed once
+        """
+        if self._ignorevolumes is None:
+            self._ignorevolumes = frozenset(v.strip() for v in self.IGNOREVOLUMES.split(',') if v.strip())
+        return self._ignorevolumes
+
+    @property
+    def account(self):
+        """
+        Account ID. Falls back to STS if set_account could not find it
+        """
+        if not self._account:
+            start = time.perf_counter()
+            self._account = connect('sts').get_caller_identity()['Account']
+            STARTUP['account_ms'] = (time.perf_counter() - start) * 1000
+            STARTUP['account_source'] = 'sts'
+        return self._account
+
+    def set_account(self, event, context):
+        """
+        Take the account ID from the function ARN or the event, if not known
+        """
+        if self._account:
+            return
+        functionarn = getattr(context, 'invoked_function_arn', '') or ''
+        if functionarn.count(':') >= 4:
+            self._account = functionarn.split(':')[4]
+            STARTUP['account_source'] = 'context'
+        elif isinstance(event, dict) and event.get('account'):
+            self._account = event['account']
+            STARTUP['account_source'] = 'event'
+
+CONFIG = LambdaConfig()
+STARTUP = { 'cold': True, 'import_ms': 0.0, 'config_ms': 0.0, 'clients_ms': 0.0, 'account_ms': 0.0, 'account_source': None }
 MYREGION = os.environ['AWS_REGION']
-sts = boto3.client('sts')
-MYACCOUNT = sts.get_caller_identity()['Account']    # Account ID
-REGION_SETUP = {} # Cache for regionSetup func
+REGION_SETUP = {} # Cache for regionSetup func, persisted to STATEBUCKET
+REGION_SETUP_VERSION = 2 # bump when the regionSetup steps change to redo them
+REGION_SETUP_KEY = 'region-setup.json'
+PLAN_PREFIX = 'plans/' # STATEBUCKET prefix of the stored plans
+PLAN_LATEST_KEY = 'plans/latest.json' # copy of the most recent plan
+region_setup_lock = threading.Lock()
+RESOURCES = {} # Per-invocation cache of described volumes and snapshots
+TA_CHECK_ID = 'DAvU99Dc4C' # Trusted Advisor check id for Underutilized Amazon EBS Volumes
+DESCRIBE_BATCH = 200 # max volume or snapshot ids per describe filter
+ATTACH_HISTORY = {} # Cache of attach/detach history per region
+TAG_INDEX = {} # Cache of the tags the app reads, per region
+TAG_INDEX_TTL_SECS = 900 # how long a region's tag index is used before it is rebuilt
+FOREIGN_SNAPSHOTS = set() # snapshot ids found not to be idle volume snapshots, kept for the container lifetime
+tag_index_lock = threading.Lock()
+HISTORY_SYNC_SECS = 300 # how often a cached history is brought up to date
+HISTORY_OVERLAP_SECS = 3600 # re-read this much before the high-water mark (CloudTrail delivery delay)
+HISTORY_BUILD_SECS = 120 # max time one call spends reading older events, the build resumes from its low-water marks
+HISTORY_EVENTS = ('AttachVolume', 'DetachVolume')
+NOTIFICATIONS = {} # Digest of deleted volumes per email recipient
+EMAIL_TEMPLATES = {} # Notification templates, built on first use
+RATE_LIMITS = { 'cloudtrail': 2.0, 'ses': 'SESSENDRATE' } # max calls per second per region, or the CONFIG setting holding it
+THROTTLE_CODES = ('Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequestsException')
+LIMITERS = {} # RateLimiter per (region, service), shared by all clients
+REJECTED = {} # volume id -> (reason, expiry) for volumes found ineligible, kept for the container lifetime
+RECHECK_SECS = 21600 # how long attached, excepted or recently attached volumes are remembered
+VOLUME_ID = re.compile(r'^vol-[0-9a-f]{8,17}$')
+API_CALLS = { 'count': 0 } # AWS API requests sent in this invocation, retries included
+api_calls_lock = threading.Lock()
+CANDIDATE_QUEUE = 'idle-volumes' # partition key of the candidate table
+CANDIDATE_INDEX = 'idle-volume-ids' # partition key of the region#volume id -> queued Priority records
+DRAIN_BATCH = 100 # candidates read from the candidate table at a time
+DYNAMODB_BATCH = 25 # max requests per BatchWriteItem
+DYNAMODB_GET_BATCH = 100 # max keys per BatchGetItem
+DRAIN_MARGIN_MS = 60000 # stop draining with this much Lambda time left
+SCHEDULERS = {} # SnapshotScheduler per region
+SCHEDULER_TTL_SECS = 60 # how long a region's pending snapshot count is trusted
+SNAPSHOT_RETRIES = 4 # create_snapshot attempts on SnapshotCreationPerVolumeRateExceeded
+SNAPSHOT_RETRY_SECS = 4 # first retry delay, doubled on each attempt
+scheduler_lock = threading.Lock()
+METRICS = {} # (phase, region) -> metric values for this invocation
+METRICS_NAMESPACE = 'TAEBSVolDel' # CloudWatch namespace of the embedded metrics
+metrics_lock = threading.Lock()
+CURRENT = threading.local() # phase being timed in each thread
+
+#======================================================================
+#
+class RateLimiter:
+    """
+    Token bucket shared by every client of a service in a region. On a
+    throttling response the rate is halved and a jittered pause is added;
+    each successful call brings the rate back up towards the maximum.
+    """
+    def __init__(self, maxrate):
+        self.maxrate = maxrate
+        self.rate = maxrate
+        self.tokens = 1.0
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, **kwargs):
+        """
+        Wait for a token. Registered on before-send so every attempt,
+        including botocore retries, is paced
+        """
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(1.0, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                time.sleep((1 - self.tokens) / self.rate)
+
+    def feedback(self, response=None, **kwargs):
+        """
+        Adjust the rate from the outcome of an attempt. Registered on
+        needs-retry and never itself requests a retry
+        """
+        if response is None:
+            return
+        code = response[1].get('Error', {}).get('Code')
+        with self.lock:
+            if code in THROTTLE_CODES:
+                self.rate = max(self.rate / 2, self.maxrate / 16)
+                self.tokens = -random.random()
+                print(f'Throttled ({code}). Slowing down to {self.rate:.2f} calls/sec')
+            elif response[0].status_code < 400:
+                self.rate = min(self.maxrate, self.rate + self.maxrate / 10)
+
+#======================================================================
+#
+class SnapshotScheduler:
+    """
+    Admits idle volume snapshots in a region while fewer than limit are in
+    flight. In flight starts as the number of pending snapshots tagged
+    SnapshotReason=Idle Volume and goes up with each snapshot admitted.
+    """
+    def __init__(self, region, limit):
+        self.region = region
+        self.limit = limit
+        self.inflight = None
+        self.counted = 0
+        self.lock = threading.Lock()
+
+    def count_pending(self):
+        """
+        Count the idle volume snapshots still pending in the region
+        """
+        with timed('snapshot', self.region):
+            ec2 = connect('ec2', self.region)
+            paginator = ec2.get_paginator('describe_snapshots')
+            pages = paginator.paginate(
+                OwnerIds=['self'],
+                Filters=[
+                    { 'Name': 'status', 'Values': ['pending'] },
+                    { 'Name': 'tag:SnapshotReason', 'Values': ['Idle Volume'] }
+                ]
+            )
+            return sum(len(page['Snapshots']) for page in pages)
+
+    def available(self):
+        """
+        Return the number of snapshots that can be admitted now
+        """
+        with self.lock:
+            if self.inflight is None or time.time() - self.counted > SCHEDULER_TTL_SECS:
+                self.inflight = self.count_pending()
+                self.counted = time.time()
+                print(f'{self.inflight} idle volume snapshots pending in {self.region}')
+            return max(0, self.limit - self.inflight)
+
+    def admit(self):
+        """
+        Take a slot for a new snapshot. Return False if there is none
+        """
+        if not self.available():
+            return False
+        with self.lock:
+            self.inflight += 1
+        return True
+
+    def release(self):
+        """
+        Give back a slot whose snapshot was not created
+        """
+        with self.lock:
+            self.inflight -= 1
+
+    def full(self):
+        """
+        EC2 refused a snapshot for the account limit. Admit no more until recounted
+        """
+        with self.lock:
+            self.inflight = max(self.inflight or 0, self.limit)
+
+# ---------------------------------------------------------------------
+def snapshot_scheduler(region):
+    """
+    Return the region's SnapshotScheduler, shared by all threads
+    """
+    with scheduler_lock:
+        if region not in SCHEDULERS:
+            SCHEDULERS[region] = SnapshotScheduler(region, CONFIG.SNAPSHOTCONCURRENCY)
+        return SCHEDULERS[region]
 
 #======================================================================
 #
 def connect(service, region=MYREGION):
     """
     Return client object for an AWS service. Connect if not already. This method
-    uses a persistent connection over the life of the lambda.
+    uses a persistent connection over the life of the lambda. Each region gets
+    its own session so regions can be worked from separate threads. Services
+    listed in RATE_LIMITS are paced by a RateLimiter shared across clients.
+    """
+    start = time.perf_counter()
+    with client_lock:
+        if not region in client:
+            client[region] = {}
+            sessions[region] = boto3.session.Session()
+
+        if service not in client[region]:
+            try:
+                session = sessions[region]
+                if service in RATE_LIMITS:
+                    c = session.client(service,region_name=region,config=Config(retries={'mode': 'standard', 'max_attempts': 10}))
+                    rate = RATE_LIMITS[service]
+                    if isinstance(rate, str):
+                        rate = getattr(CONFIG, rate)
+                    limiter = LIMITERS.setdefault((region, service), RateLimiter(rate))
+                    eventname = c.meta.service_model.service_id.hyphenize()
+                    c.meta.events.register(f'before-send.{eventname}', limiter.acquire)
+                    c.meta.events.register_first(f'needs-retry.{eventname}', limiter.feedback)
+                else:
+                    c = session.client(service,region_name=region)
+                c.meta.events.register('before-send', count_api_call)
+                c.meta.events.register('before-call', api_call_started)
+                c.meta.events.register('after-call', partial(api_call_finished, region))
+                c.meta.events.register('after-call-error', partial(api_call_finished, region))
+                c.meta.events.register_first('needs-retry', partial(api_call_retried, region))
+                client[region][service] = c
+                STARTUP['clients_ms'] += (time.perf_counter() - start) * 1000
+            except Exception as e:
+                print(e)
+                print(f'could not connect to {service} in {region}')
+                raise e
+
+    return client[region][service]
+
+def count_api_call(**kwargs):
     """
-    if not region in client:
-        client[region] = {}
+    before-send handler counting every request sent, retries included
+    """
+    with api_calls_lock:
+        API_CALLS['count'] += 1
+
+#======================================================================
+# Metrics. Phases are timed with timed() or @phase, and every API call is
+# counted against the phase running in its thread. emit_metrics writes
+# them to stdout in CloudWatch Embedded Metric Format at the end of each
+# invocation
+#
+def record_metric(phase, region, name, value):
+    """
+    Add value to a metric of a phase in a region
+    """
+    with metrics_lock:
+        values = METRICS.setdefault((phase, region), { 'Count': 0, 'Duration': 0.0, 'Calls': 0, 'ApiLatency': 0.0, 'Throttles': 0 })
+        values[name] += value
 
-    if service not in client[region]:
+@contextmanager
+def timed(phase, region=None):
+    """
+    Time a block as a phase. API calls made inside it are counted to it
+    """
+    outer = getattr(CURRENT, 'phase', None)
+    CURRENT.phase = phase
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        CURRENT.phase = outer
+        record_metric(phase, region or MYREGION, 'Count', 1)
+        record_metric(phase, region or MYREGION, 'Duration', (time.perf_counter() - start) * 1000)
+
+def phase(name):
+    """
+    Decorator timing a function as a phase. The region is taken from the
+    function's region argument, if it has one
+    """
+    def decorate(func):
+        argnames = func.__code__.co_varnames[:func.__code__.co_argcount]
+        index = argnames.index('region') if 'region' in argnames else None
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            region = kwargs.get('region')
+            if region is None and index is not None and index < len(args):
+                region = args[index]
+            with timed(name, region):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def api_call_started(context=None, **kwargs):
+    """
+    before-call handler noting the phase and start time of an API call
+    """
+    if context is not None:
+        context['metrics'] = (getattr(CURRENT, 'phase', None) or 'other', time.perf_counter())
+
+def api_call_finished(region, context=None, **kwargs):
+    """
+    after-call and after-call-error handler recording an API call, retries included
+    """
+    if context and 'metrics' in context:
+        phasename, start = context.pop('metrics')
+        record_metric(phasename, region, 'Calls', 1)
+        record_metric(phasename, region, 'ApiLatency', (time.perf_counter() - start) * 1000)
+
+def api_call_retried(region, response=None, **kwargs):
+    """
+    needs-retry handler counting throttled attempts. Never requests a retry
+    """
+    if response is not None and response[1].get('Error', {}).get('Code') in THROTTLE_CODES:
+        record_metric(getattr(CURRENT, 'phase', None) or 'other', region, 'Throttles', 1)
+
+def emit_metrics():
+    """
+    Print one Embedded Metric Format line per phase and region, then reset
+    """
+    with metrics_lock:
+        metrics = sorted(METRICS.items())
+        METRICS.clear()
+
+    timestamp = int(time.time() * 1000)
+    for (phasename, region), values in metrics:
+        print(json.dumps({
+            '_aws': {
+                'Timestamp': timestamp,
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [['Phase', 'Region'], ['Phase']],
+                    'Metrics': [
+                        { 'Name': 'Count', 'Unit': 'Count' },
+                        { 'Name': 'Duration', 'Unit': 'Milliseconds' },
+                        { 'Name': 'Calls', 'Unit': 'Count' },
+                        { 'Name': 'ApiLatency', 'Unit': 'Milliseconds' },
+                        { 'Name': 'Throttles', 'Unit': 'Count' }
+                    ]
+                }]
+            },
+            'Phase': phasename,
+            'Region': region,
+            **{ name: round(value, 2) for name, value in values.items() }
+        }))
+
+def queue_notification(contactEmailAddress, volinfo):
+    """
+    Add a deleted volume to the recipient's digest. Nothing is sent until
+    send_notifications is called
+    volinfo = { volid:"", snapshotid: "", region: "" }
+    """
+    NOTIFICATIONS.setdefault(contactEmailAddress, []).append(volinfo)
+
+# ---------------------------------------------------------------------
+@phase('notify')
+def send_notifications():
+    """
+    Send one digest email per recipient for every volume queued so far. SES
+    calls are paced by the ses RateLimiter and a failed send does not stop
+    the remaining recipients from being notified.
+    Return number of emails sent
+    """
+    sent = 0
+    while NOTIFICATIONS:
+        contactEmailAddress, volinfos = NOTIFICATIONS.popitem()
         try:
-            client[region][service] = boto3.client(service,region_name=region)
-        except Exception as e:
+            notify_owner(contactEmailAddress, volinfos)
+            sent += 1
+        except ClientError as e:
             print(e)
-            print(f'could not connect to {service} in {region}')
-            raise e
+            print(f'ERROR: could not notify {contactEmailAddress} of {len(volinfos)} deleted volumes')
 
-    return client[region][service]
+    return sent
 
-def notify_owner(contactEmailAddress, volinfo, accountId=MYACCOUNT):
-    """
-    Create email from a template
-    volinfo = { idlethresh: "", volid:"", snapshotid: "", region: "" }
-    """
-    template = [
-        "The following EBS volume in region {} has been unattached for more than {} days. The volume has been snapshotted and deleted. Please use the instructions below to recover the volume if the data is needed in the future: <br> <br>",
-        "",
-        "<b>Account ID:</b> {}<br>",
-        "<b>Region: </b> {}<br>",
-        "<b>Volume ID:</b> {}<br>",
-        "<b>Snapshot ID:</b> {}",
-        "<br>",
-        "<p>To recover this volume, create a new volume from the snapshot. See <a href='https://docs.aws.amazon.com/AWSEC2/latest/UserGuide/ebs-restoring-volume.html'>AWS Documentation</a> for more information.</p>"
-        "<p>Note: idle (unattached) EBS volumes are billed based on the allocated volume size. Volumes that have been idle for more than {} days will be snapshotted and deleted per corporate Cloud governance policy."
-    ]
-    tempout = '\n'
-    tempout = tempout.join(template)
-    emailBody = tempout.format(volinfo['region'], IDLETHRESH, accountId, volinfo['region'], volinfo['volid'], volinfo['snapshotid'], IDLETHRESH)
+# ---------------------------------------------------------------------
+def email_templates():
+    """
+    Return the notification templates, building them on first use only.
+    IdleThresh is filled in here; the header takes {count} and each row the
+    volinfo fields
+    """
+    if EMAIL_TEMPLATES:
+        return EMAIL_TEMPLATES
+
+    EMAIL_TEMPLATES.update({
+        'html': {
+            'header': '\n'.join([
+                "The following {count} EBS volume(s) have been unattached for more than %d days. The volumes have been snapshotted and deleted. Please use the instructions below to recover a volume if the data is needed in the future: <br> <br>" % CONFIG.IDLETHRESH,
+                "<table border='1' cellpadding='4' cellspacing='0'>",
+                "<tr><th>Account ID</th><th>Region</th><th>Volume ID</th><th>Snapshot ID</th></tr>",
+                ""
+            ]),
+            'row': "<tr><td>{account}</td><td>{region}</td><td>{volid}</td><td>{snapshotid}</td></tr>\n",
+            'footer': '\n'.join([
+                "</table>",
+                "<br>",
+                "<p>To recover a volume, create a new volume from the snapshot. See <a href='https://docs.aws.amazon.com/AWSEC2/latest/UserGuide/ebs-restoring-volume.html'>AWS Documentation</a> for more information.</p>"
+                "<p>Note: idle (unattached) EBS volumes are billed based on the allocated volume size. Volumes that have been idle for more than %d days will be snapshotted and deleted per corporate Cloud governance policy." % CONFIG.IDLETHRESH
+            ])
+        },
+        'text': {
+            'header': '\n'.join([
+                "The following {count} EBS volume(s) have been unattached for more than %d days. The volumes have been snapshotted and deleted. Please use the instructions below to recover a volume if the data is needed in the future:" % CONFIG.IDLETHRESH,
+                "",
+                "Account ID    Region            Volume ID                Snapshot ID",
+                ""
+            ]),
+            'row': "{account:<14}{region:<18}{volid:<25}{snapshotid}\n",
+            'footer': '\n'.join([
+                "",
+                "To recover a volume, create a new volume from the snapshot. See https://docs.aws.amazon.com/AWSEC2/latest/UserGuide/ebs-restoring-volume.html for more information.",
+                "",
+                "Note: idle (unattached) EBS volumes are billed based on the allocated volume size. Volumes that have been idle for more than %d days will be snapshotted and deleted per corporate Cloud governance policy." % CONFIG.IDLETHRESH
+            ])
+        }
+    })
+
+    return EMAIL_TEMPLATES
+
+# ---------------------------------------------------------------------
+def render_email(volinfos, accountId):
+    """
+    Render the HTML and text bodies for a list of volumes in one pass from
+    the precompiled email_templates
+    return (html, text)
+    """
+    start = time.perf_counter()
+    bodies = []
+    for variant in ('html', 'text'):
+        template = email_templates()[variant]
+        out = io.StringIO()
+        out.write(template['header'].format(count=len(volinfos)))
+        row = template['row']
+        for volinfo in volinfos:
+            out.write(row.format(account=accountId, **volinfo))
+        out.write(template['footer'])
+        bodies.append(out.getvalue())
+
+    print(f'Rendered email for {len(volinfos)} volumes in {(time.perf_counter() - start) * 1000:.2f} ms')
+    return bodies[0], bodies[1]
+
+# ---------------------------------------------------------------------
+def notify_owner(contactEmailAddress, volinfos, accountId=None):
+    """
+    Email the recipient a table of their deleted volumes
+    volinfos = [ { volid:"", snapshotid: "", region: "" } ]
+    """
+    htmlBody, textBody = render_email(volinfos, accountId or CONFIG.account)
 
-    sendSesEmail(contactEmailAddress, emailBody)
+    sendSesEmail(contactEmailAddress, htmlBody, textBody=textBody)
 
 # ---------------------------------------------------------------------
-def sendSesEmail(toEmailAddress, emailBody, fromEmailAddress=FROM_EMAIL):
+def sendSesEmail(toEmailAddress, emailBody, fromEmailAddress=None, textBody=None):
     """
-    Send an email using Simple Email Service
+    Send an email using Simple Email Service. emailBody is the HTML body and
+    is also used as the text body unless textBody is given
     """
     ses = connect('ses')
 
     response = ses.send_email(
-        Source=FROM_EMAIL,
+        Source=CONFIG.FROM_EMAIL,
         Destination={
             'ToAddresses': [toEmailAddress],
         },
         Message={
             'Subject': {
-                'Data': 'Idle EBS Volume Deleted',
+                'Data': 'Idle EBS Volumes Deleted',
                 'Charset': 'UTF-8',
             },
             'Body': {
                 'Text': {
-                    'Data': emailBody,
+                    'Data': textBody or emailBody,
                     'Charset': 'UTF-8',
                 },
                 'Html': {
@@ -126,7 +590,7 @@ def sendSesEmail(toEmailAddress, emailBody, fromEmailAddress=FROM_EMAIL):
                 }
             }
         },
-        ReplyToAddresses=[fromEmailAddress]
+        ReplyToAddresses=[fromEmailAddress or CONFIG.FROM_EMAIL]
     )
 
 # ---------------------------------------------------------------------
@@ -141,42 +605,139 @@ def get_volume_info(volid, region):
     get volume info
     return response (json)
     """
-    ec2 = connect('ec2', region)
-    mystatus = ec2.describe_volumes(
-        VolumeIds=[volid],
-    )
-    return mystatus['Volumes'][0]
+    return describe_resource(volid, 'volume', region)
 
 # ---------------------------------------------------------------------
-def get_volume_status(volid, region):
+@phase('describe')
+def describe_resource(ec2id, ec2type, region):
     """
-    get volume status
+    Describe a volume or snapshot once per invocation. Later lookups of the
+    same resource, including its tags, are served from RESOURCES
     return response (json)
     """
+    key = (region, ec2type, ec2id)
+    if key not in RESOURCES:
+        ec2 = connect('ec2', region)
+        if ec2type == 'volume':
+            response = ec2.describe_volumes(VolumeIds=[ec2id])
+            RESOURCES[key] = response['Volumes'][0]
+        elif ec2type == 'snapshot':
+            response = ec2.describe_snapshots(SnapshotIds=[ec2id])
+            RESOURCES[key] = response['Snapshots'][0]
+
+    return RESOURCES[key]
+
+# ---------------------------------------------------------------------
+@phase('describe')
+def describe_volumes_batch(volids, region):
+    """
+    Describe many volumes with one paginated call per DESCRIBE_BATCH ids.
+    Volumes that no longer exist are simply absent from the result.
+    return dict of volume id -> volume (json)
+    """
     ec2 = connect('ec2', region)
-    mystatus = ec2.describe_volume_status(
-        VolumeIds=[volid],
+    paginator = ec2.get_paginator('describe_volumes')
+    volumes = {}
+    for i in range(0, len(volids), DESCRIBE_BATCH):
+        pages = paginator.paginate(
+            Filters=[
+                {
+                    'Name': 'volume-id',
+                    'Values': volids[i:i + DESCRIBE_BATCH]
+                }
+            ]
+        )
+        for page in pages:
+            for volume in page['Volumes']:
+                volumes[volume['VolumeId']] = volume
+                RESOURCES[(region, 'volume', volume['VolumeId'])] = volume
+
+    return volumes
+
+# ---------------------------------------------------------------------
+@phase('describe')
+def describe_snapshots_batch(snapshotids, region):
+    """
+    Describe many of this account's snapshots with one paginated call per
+    DESCRIBE_BATCH ids. Snapshots that no longer exist are simply absent
+    from the result.
+    return dict of snapshot id -> snapshot (json)
+    """
+    ec2 = connect('ec2', region)
+    paginator = ec2.get_paginator('describe_snapshots')
+    snapshots = {}
+    for i in range(0, len(snapshotids), DESCRIBE_BATCH):
+        pages = paginator.paginate(
+            OwnerIds=['self'],
+            Filters=[
+                {
+                    'Name': 'snapshot-id',
+                    'Values': snapshotids[i:i + DESCRIBE_BATCH]
+                }
+            ]
+        )
+        for page in pages:
+            for snapshot in page['Snapshots']:
+                snapshots[snapshot['SnapshotId']] = snapshot
+                RESOURCES[(region, 'snapshot', snapshot['SnapshotId'])] = snapshot
+
+    return snapshots
+
+# ---------------------------------------------------------------------
+@phase('tags')
+def tag_index(region):
+    """
+    The tags the app reads (EXCEPTTAG, MAILTOOWNER, SnapshotReason and
+    DeleteEBSVolOnCompletion) for every volume and snapshot in a region,
+    from one paginated describe_tags. The index is kept for
+    TAG_INDEX_TTL_SECS, expired regions are evicted.
+    return dict of resource id -> { tag key: value }
+    """
+    now = time.time()
+    with tag_index_lock:
+        for expired in [r for r, index in TAG_INDEX.items() if now - index['built'] > TAG_INDEX_TTL_SECS]:
+            del TAG_INDEX[expired]
+        if region in TAG_INDEX:
+            return TAG_INDEX[region]['tags']
+
+    keys = [key for key in (CONFIG.EXCEPTTAG, CONFIG.MAILTOOWNER, 'SnapshotReason', 'DeleteEBSVolOnCompletion') if key]
+    ec2 = connect('ec2', region)
+    paginator = ec2.get_paginator('describe_tags')
+    pages = paginator.paginate(
+        Filters=[
+            {
+                'Name': 'key',
+                'Values': sorted(set(keys))
+            },
+            {
+                'Name': 'resource-type',
+                'Values': ['volume', 'snapshot']
+            }
+        ]
     )
-    return mystatus['VolumeStatuses']
+    tags = {}
+    for page in pages:
+        for tag in page['Tags']:
+            tags.setdefault(tag['ResourceId'], {})[tag['Key']] = tag['Value']
+
+    with tag_index_lock:
+        TAG_INDEX[region] = { 'built': now, 'tags': tags }
+    print(f'Indexed tags of {len(tags)} volumes and snapshots in {region}')
+    return tags
 
 # ---------------------------------------------------------------------
 def get_tags(ec2id, ec2type, region):
     """
-    get tags
+    get tags. Resources described in this invocation use their described
+    tags, others the region's tag index (which only holds the tags the app
+    reads)
     return tags (json)
     """
-    mytags = []
-    ec2 = connect('ec2', region)
-    if ec2type == 'volume':
-        response = ec2.describe_volumes(VolumeIds=[ec2id])
-        if 'Tags' in response['Volumes'][0]:
-            mytags = response['Volumes'][0]['Tags']
-    elif ec2type == 'snapshot':
-        response = ec2.describe_snapshots(SnapshotIds=[ec2id])
-        if 'Tags' in response['Snapshots'][0]:
-            mytags = response['Snapshots'][0]['Tags']
+    key = (region, ec2type, ec2id)
+    if key in RESOURCES:
+        return RESOURCES[key].get('Tags', [])
 
-    return mytags
+    return [{ 'Key': k, 'Value': v } for k, v in tag_index(region).get(ec2id, {}).items()]
 
 # ---------------------------------------------------------------------
 def get_tag(ec2id, ec2type, region, tagname):
@@ -196,7 +757,14 @@ def has_tag(ec2id, ec2type, region, tagname, tagvalue=False):
     Determine if a volume has a specific tag
     Returns boolean
     """
-    tags = get_tags(ec2id, ec2type, region)
+    return tags_match(get_tags(ec2id, ec2type, region), tagname, tagvalue)
+
+# ---------------------------------------------------------------------
+def tags_match(tags, tagname, tagvalue=False):
+    """
+    Determine if a list of tags contains a specific tag (and value)
+    Returns boolean
+    """
     for tag in tags:
         if tag['Key'] == tagname:
             if tagvalue:
@@ -210,15 +778,33 @@ def has_tag(ec2id, ec2type, region, tagname, tagvalue=False):
     return False
 
 # ---------------------------------------------------------------------
+@phase('snapshot')
 def snapshot_volume(volid, region):
     """
     Create a snapshot. Do dry run if not GOLIVE. Tag the snapshot with
     DeleteEBSVolOnCompletion. A CloudWatch rule will trigger the volume
-    deletion process.
+    deletion process. SnapshotCreationPerVolumeRateExceeded is retried
+    with backoff.
     """
 
     ec2 = connect('ec2', region)
 
+    for attempt in range(SNAPSHOT_RETRIES):
+        try:
+            return create_snapshot(ec2, volid)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'SnapshotCreationPerVolumeRateExceeded' or attempt == SNAPSHOT_RETRIES - 1:
+                raise e
+            record_metric('snapshot', region, 'Throttles', 1)
+            delay = SNAPSHOT_RETRY_SECS * 2 ** attempt * (0.5 + random.random() / 2)
+            print(f'Snapshot rate exceeded for {volid} in region {region}. Retrying in {delay:.1f} seconds')
+            time.sleep(delay)
+
+# ---------------------------------------------------------------------
+def create_snapshot(ec2, volid):
+    """
+    Create the tagged idle volume snapshot
+    """
     response = ec2.create_snapshot(
         Description='Snapshot of idle volume before deletion',
         VolumeId=volid,
@@ -237,7 +823,7 @@ def snapshot_volume(volid, region):
                     {
 
                         'Key': 'DeleteEBSVolOnCompletion',
-                        'Value': GOLIVE
+                        'Value': CONFIG.GOLIVE
                     }
                 ]
             },
@@ -247,23 +833,31 @@ def snapshot_volume(volid, region):
     return
 
 # ---------------------------------------------------------------------
+@phase('delete')
 def delete_volume(volid, region):
     """
     Delete a volume
+    return True if the volume was deleted, False in Dryrun mode
     """
     Dryrun = True
-    if GOLIVE.lower() == 'true':
+    if CONFIG.GOLIVE.lower() == 'true':
         Dryrun = False
     else:
         print('Running in Dryrun mode')
 
     ec2 = connect('ec2', region)
 
-    response = ec2.delete_volume(
-        VolumeId=volid,
-        DryRun=Dryrun
-    )
-    return
+    try:
+        response = ec2.delete_volume(
+            VolumeId=volid,
+            DryRun=Dryrun
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'DryRunOperation':
+            print(f'Dryrun: volume {volid} in region {region} would have been deleted')
+            return False
+        raise e
+    return True
 
 # ---------------------------------------------------------------------
 def hasowner(volid, region, tagname):
@@ -282,64 +876,212 @@ def hasowner(volid, region, tagname):
     return False
 
 # ---------------------------------------------------------------------
-def recentlyAttached(volid, region, thresholddays):
+def load_state(key):
     """
-    Return bool indicating whether last volume attachment was within the
-    threshold period
+    Load a JSON state object from STATEBUCKET
+    return state (json) or None if there is none
     """
-    ct = connect('cloudtrail', region)
-    most_recent = ''
-    mount_found = False
-    lastmounteddays = 999
-    today = datetime.today()
+    if not CONFIG.STATEBUCKET:
+        return None
 
-    token = 'start'
-    events = []
-    todate = datetime.today()
-    response = ct.lookup_events(
-        MaxResults=50,
-        LookupAttributes=[
+    s3 = connect('s3')
+    try:
+        response = s3.get_object(
+            Bucket=CONFIG.STATEBUCKET,
+            Key=key
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchKey':
+            return None
+        raise e
+
+    return json.loads(response['Body'].read())
+
+# ---------------------------------------------------------------------
+def save_state(key, state):
+    """
+    Persist a JSON state object to STATEBUCKET
+    """
+    if not CONFIG.STATEBUCKET:
+        return
+
+    s3 = connect('s3')
+    s3.put_object(
+        Bucket=CONFIG.STATEBUCKET,
+        Key=key,
+        Body=json.dumps(state),
+        ContentType='application/json'
+    )
+
+# ---------------------------------------------------------------------
+def cloudtrail_events(region, attributekey, attributevalue, starttime, endtime):
+    """
+    Generator over the CloudTrail events matching one lookup attribute. Each
+    page is requested only when the previous one has been consumed, so at
+    most one page is held in memory and callers can stop early
+    """
+    ct = connect('cloudtrail', region)
+    kwargs = {
+        'MaxResults': 50,
+        'LookupAttributes': [
             {
-                'AttributeKey': 'ResourceName',
-                'AttributeValue': volid
+                'AttributeKey': attributekey,
+                'AttributeValue': attributevalue
             }
         ],
-        StartTime=todate - timedelta(days=thresholddays),
-        EndTime=todate
-    )
-
-    events = response['Events']
+        'StartTime': starttime,
+        'EndTime': endtime
+    }
+    while True:
+        response = ct.lookup_events(**kwargs)
+        for event in response['Events']:
+            yield event
+        if 'NextToken' not in response:
+            return
+        kwargs['NextToken'] = response['NextToken']
 
-    while 'NextToken' in response:
+# ---------------------------------------------------------------------
+def attach_history(region):
+    """
+    Return (dict of volume id -> epoch of the most recent AttachVolume or
+    DetachVolume event in the region, bool whether the history covers the
+    whole IdleThresh period).
+    New events are read from the high-water mark (hwm). Older events are
+    read back from a low-water mark (lwm) per event name for at most
+    HISTORY_BUILD_SECS per call, so a large region is built over several
+    calls. The history is persisted after each call so later cold starts
+    resume where it stopped.
+    """
+    now = time.time()
+    oldest = now - CONFIG.IDLETHRESH * 86400
+    history = ATTACH_HISTORY.get(region)
+    if history and now - history['synced'] < HISTORY_SYNC_SECS:
+        return history['volumes'], history['complete']
 
-        time.sleep(1)
-        response = ct.lookup_events(
-            NextToken=response['NextToken'],
-            MaxResults=50,
-            LookupAttributes=[
-                {
-                    'AttributeKey': 'ResourceName',
-                    'AttributeValue': volid
-                }
-            ],
-            StartTime=todate - timedelta(days=thresholddays),
-            EndTime=todate
+    if not history:
+        try:
+            history = load_state(f'attach-history/{region}.json')
+        except ClientError as e:
+            print(e)
+            print(f'Could not load attach history for {region}. Building it from CloudTrail')
+            history = None
+        if not history:
+            history = { 'hwm': now, 'lwm': dict.fromkeys(HISTORY_EVENTS, now), 'volumes': {} }
+        # histories persisted before the low-water marks were complete
+        history.setdefault('lwm', dict.fromkeys(HISTORY_EVENTS, 0))
+
+    volumes = history['volumes']
+
+    def read_events(eventname, starttime, endtime, deadline=None):
+        """
+        Record the events of one name, most recent first. Stop at the
+        deadline and return the time of the last event read, or None when
+        all events were read
+        """
+        events = cloudtrail_events(
+            region,
+            'EventName',
+            eventname,
+            datetime.utcfromtimestamp(starttime),
+            datetime.utcfromtimestamp(endtime)
+        )
+        for event in events:
+            eventTS = event['EventTime'].timestamp()
+            for resource in event.get('Resources', []):
+                volid = resource.get('ResourceName', '')
+                if volid.startswith('vol-') and eventTS > volumes.get(volid, 0):
+                    volumes[volid] = eventTS
+            if deadline and time.time() > deadline:
+                return eventTS
+        return None
+
+    # Events since the high-water mark. A new history is read back from now
+    if history['hwm'] < now:
+        for eventname in HISTORY_EVENTS:
+            read_events(eventname, max(history['hwm'] - HISTORY_OVERLAP_SECS, oldest), now)
+        history['hwm'] = now
+
+    # Events before the low-water marks, until the whole period is read
+    deadline = time.time() + HISTORY_BUILD_SECS
+    for eventname in HISTORY_EVENTS:
+        if history['lwm'][eventname] > oldest and time.time() < deadline:
+            stopped = read_events(eventname, oldest, history['lwm'][eventname], deadline)
+            history['lwm'][eventname] = stopped or oldest
+
+    # Attachments older than the threshold can never make a volume recent
+    history['volumes'] = { volid: ts for volid, ts in volumes.items() if ts >= oldest }
+    history['complete'] = all(lwm <= oldest for lwm in history['lwm'].values())
+    history['synced'] = now
+    ATTACH_HISTORY[region] = history
+    if not history['complete']:
+        print(f'Attach history for {region} is read back to {datetime.utcfromtimestamp(max(history["lwm"].values()))}, the build continues on the next call')
+    try:
+        save_state(
+            f'attach-history/{region}.json',
+            { 'hwm': history['hwm'], 'lwm': history['lwm'], 'volumes': history['volumes'] }
         )
+    except ClientError as e:
+        print(e)
+        print(f'Could not persist attach history for {region}')
+
+    return history['volumes'], history['complete']
+
+# ---------------------------------------------------------------------
+@phase('recentlyAttached')
+def recentlyAttached(volid, region, thresholddays):
+    """
+    Return bool indicating whether last volume attachment was within the
+    threshold period
+    """
+    try:
+        volumes, complete = attach_history(region)
+    except ClientError as e:
+        print(e)
+        print(f'Could not build attach history for {region}. Searching CloudTrail for {volid}')
+        return scanVolumeHistory(volid, region, thresholddays)
+
+    # A volume missing from a partial history may have been attached in the
+    # period not read yet
+    if volid not in volumes and not complete:
+        return scanVolumeHistory(volid, region, thresholddays)
+
+    lastmounteddays = 999
+    if volid in volumes:
+        lastmounteddays = int((time.time() - volumes[volid]) // 86400)
+
+    print(f'Volume {volid} was last attached {lastmounteddays} days ago')
 
-        events = events + response['Events']
+    return lastmounteddays < thresholddays
 
-    # Loop through Events looking for a mount
+# ---------------------------------------------------------------------
+def scanVolumeHistory(volid, region, thresholddays):
+    """
+    Return bool indicating whether last volume attachment was within the
+    threshold period by searching CloudTrail for this volume only. Used when
+    the regional attach history is not available
+    """
+    lastmounteddays = 999
+    today = datetime.today()
+    events = cloudtrail_events(
+        region,
+        'ResourceName',
+        volid,
+        today - timedelta(days=thresholddays),
+        today
+    )
+
+    # Events are returned most recent first so the first mount found is the
+    # last one. Stop paging as soon as it is found
     for event in events:
 
         if event['EventName'] == 'DetachVolume' or event['EventName'] == 'AttachVolume':
             # Get duration since detached
-            mount_found = True
             eventTS = event['EventTime']
             eventTS = eventTS.replace(tzinfo=None)
 
             eventEt = today - eventTS
-            if eventEt.days < lastmounteddays:
-                lastmounteddays = eventEt.days
+            lastmounteddays = eventEt.days
+            break
 
     print(f'Volume {volid} was last attached {lastmounteddays} days ago')
 
@@ -350,7 +1092,7 @@ def topicExists(region, snstopic):
     sns = connect('sns', region)
     try:
         response = sns.get_topic_attributes(
-            TopicArn='arn:aws:sns:' + region + ':' + MYACCOUNT + ':' + snstopic
+            TopicArn='arn:aws:sns:' + region + ':' + CONFIG.account + ':' + snstopic
         )
     except ClientError as e:
         if e.response['Error']['Code'] == 'NotFound':
@@ -366,6 +1108,7 @@ def topicExists(region, snstopic):
 
     return True
 # ---------------------------------------------------------------------
+@phase('regionSetup')
 def regionSetup(region, funcname):
     '''
     Add a rule in the region to detect when the snapshot is complete
@@ -398,8 +1141,15 @@ def regionSetup(region, funcname):
             print('PutRule: Error creating CW Event rule')
             raise e
 
-    # Check the cache
-    if region in REGION_SETUP:
+    # Check the cache, loading the persisted state once per container
+    with region_setup_lock:
+        if not REGION_SETUP:
+            try:
+                REGION_SETUP.update(load_state(REGION_SETUP_KEY) or {})
+            except ClientError as e:
+                print(e)
+                print('Could not load persisted region setup state')
+    if REGION_SETUP.get(region, {}).get('version') == REGION_SETUP_VERSION:
         return True
 
     sns = connect('sns', region)
@@ -441,14 +1191,30 @@ def regionSetup(region, funcname):
         print('AddPermission: Encountered an unexpected error')
         return False
 
-    # Subscribe the Lambda to the topic
+    # Subscribe the snapshot queue (or the Lambda) to the topic
+    lambdaarn = 'arn:aws:lambda:us-east-1:' + CONFIG.account + ':function:TAEBSVolumeSnapDelete'
     try:
-        sns.subscribe(
-            TopicArn=topicarn,
-            Protocol='Lambda',
-            Endpoint='arn:aws:lambda:us-east-1:' + MYACCOUNT + ':function:TAEBSVolumeSnapDelete'
-        )
-        print(f'SNS Subscription created for {MYACCOUNT} to {topicarn}')
+        if CONFIG.SNAPSHOTQUEUE:
+            sns.subscribe(
+                TopicArn=topicarn,
+                Protocol='sqs',
+                Endpoint=CONFIG.SNAPSHOTQUEUE,
+                Attributes={ 'RawMessageDelivery': 'true' }
+            )
+            # Completions now arrive through the queue. Drop any direct
+            # Lambda subscription from an earlier setup
+            pages = sns.get_paginator('list_subscriptions_by_topic').paginate(TopicArn=topicarn)
+            for page in pages:
+                for subscription in page['Subscriptions']:
+                    if subscription['Endpoint'] == lambdaarn and subscription['SubscriptionArn'].startswith('arn:'):
+                        sns.unsubscribe(SubscriptionArn=subscription['SubscriptionArn'])
+        else:
+            sns.subscribe(
+                TopicArn=topicarn,
+                Protocol='Lambda',
+                Endpoint=lambdaarn
+            )
+        print(f'SNS Subscription created for {CONFIG.account} to {topicarn}')
     except Exception as e:
         print(e)
         print('Subscribe: Encountered an unexpected error')
@@ -505,45 +1271,809 @@ def regionSetup(region, funcname):
         print('AddPermission: Encountered an unexpected error')
         return False
 
-    REGION_SETUP[region] = True
+    with region_setup_lock:
+        REGION_SETUP[region] = {
+            'version': REGION_SETUP_VERSION,
+            'topicarn': topicarn,
+            'updated': str(datetime.today())
+        }
+        try:
+            save_state(REGION_SETUP_KEY, REGION_SETUP)
+        except ClientError as e:
+            print(e)
+            print(f'Could not persist region setup state for {region}')
     return True
 
+# ---------------------------------------------------------------------
+def get_flagged_volumes():
+    """
+    Pull the current Underutilized EBS Volumes check result from Trusted
+    Advisor. Return a list of dicts keyed like the event check-item-detail
+    """
+    support = connect('support', 'us-east-1')
+    checks = support.describe_trusted_advisor_checks(language='en')['checks']
+    metadata = [check['metadata'] for check in checks if check['id'] == TA_CHECK_ID][0]
+
+    response = support.describe_trusted_advisor_check_result(
+        checkId=TA_CHECK_ID,
+        language='en'
+    )
+
+    volumes = []
+    for resource in response['result'].get('flaggedResources', []):
+        if resource.get('isSuppressed') or resource.get('status') != 'warning':
+            continue
+        volumes.append(dict(zip(metadata, resource['metadata'])))
+
+    return volumes
+
+# ---------------------------------------------------------------------
+def monthly_cost(volume):
+    """
+    Monthly Storage Cost of a check-item-detail in dollars, None if unknown
+    """
+    try:
+        return float(str(volume.get('Monthly Storage Cost')).lstrip('$').replace(',', ''))
+    except ValueError:
+        return None
+
+# ---------------------------------------------------------------------
+def prefilter_volume(volume):
+    """
+    Cheap checks on a check-item-detail that need no API call: the payload
+    fields, the IgnoreVolumes list and volumes already found ineligible by
+    this container. Return None if the volume should be described and
+    evaluated, otherwise the reason it is ignored
+    """
+    volid = volume.get('Volume ID') or ''
+    if not VOLUME_ID.match(volid) or not volume.get('Region'):
+        return 'has no valid volume id or region in the check result'
+
+    if volid in CONFIG.ignorevolumes:
+        return 'is in IgnoreVolumes'
+
+    if CONFIG.MINMONTHLYCOST:
+        cost = monthly_cost(volume)
+        if cost is not None and cost < float(CONFIG.MINMONTHLYCOST):
+            return f'costs ${cost:.2f} per month ( < MinMonthlyCost )'
+
+    rejected = REJECTED.get(volid)
+    if rejected:
+        reason, expiry = rejected
+        if expiry > time.time():
+            return reason
+        REJECTED.pop(volid, None)
+
+    return None
+
+# ---------------------------------------------------------------------
+def reject_volume(volid, reason, expiry):
+    """
+    Remember that a volume is ineligible until expiry (epoch seconds) so
+    later events for it are dropped by prefilter_volume. Return the reason
+    """
+    REJECTED[volid] = (reason, expiry)
+    return reason
+
+# ---------------------------------------------------------------------
+def evaluate_volume(volinfo, region):
+    """
+    Apply the idle volume filters to a described volume.
+    Return None if the volume should be snapshotted and deleted, otherwise
+    the reason it is ignored
+    """
+    volid = volinfo['VolumeId']
+    recheck = time.time() + RECHECK_SECS
+
+    # 1) Ignore if volume has attachments
+    if len(volinfo['Attachments']) > 0:
+        return reject_volume(volid, 'has attachments', recheck)
+
+    # 2) Ignore if volume is < IDLETHRESH days old. It cannot qualify before then
+    cdate = volinfo['CreateTime']
+    cdate = cdate.replace(tzinfo=None)
+    age = datetime.today() - cdate
+    if age.days < CONFIG.IDLETHRESH:
+        eligible = time.time() + (timedelta(days=CONFIG.IDLETHRESH) - age).total_seconds()
+        return reject_volume(volid, f'is {age.days} days old ( < IdleThresh )', eligible)
+
+    # 3) Ignore if EXCEPTTAG tag present
+    if CONFIG.EXCEPTTAG and tags_match(volinfo.get('Tags', []), CONFIG.EXCEPTTAG, CONFIG.EXCEPTTAGVAL):
+        return reject_volume(volid, f'has exception tag {CONFIG.EXCEPTTAG}', recheck)
+
+    # 4) Get last mount and calculate idle days - ignore if below IDLETHRESH
+    if recentlyAttached(volid, region, CONFIG.IDLETHRESH):
+        return reject_volume(volid, 'was recently attached to an instance', recheck)
+
+    return None
+
+# ---------------------------------------------------------------------
+def evaluate_region(region, volids):
+    """
+    Describe the volumes of one region in bulk and apply the idle volume
+    filters, in order. Volumes that no longer exist are left out.
+    return dict of volume id -> (volume (json), None or the reason it is ignored)
+    """
+    volinfos = describe_volumes_batch(volids, region)
+    return {
+        volid: (volinfos[volid], evaluate_volume(volinfos[volid], region))
+        for volid in volids if volid in volinfos
+    }
+
+# ---------------------------------------------------------------------
+def process_volumes(volumes, context):
+    """
+    Snapshot and delete the idle volumes among a list of flagged volumes,
+    through the candidate table if there is one, otherwise in one sweep
+    """
+    if not CONFIG.CANDIDATETABLE:
+        return sweep_volumes(volumes, context.function_name)
+
+    enqueue_candidates(volumes)
+    return drain_candidates(context.function_name, context)
+
+# ---------------------------------------------------------------------
+def within_budget(budget):
+    """
+    Return bool indicating whether more API calls may be made. budget is
+    the API_CALLS count to stop at, or None for no limit
+    """
+    return not budget or API_CALLS['count'] < budget
+
+# ---------------------------------------------------------------------
+def sweep_volumes(volumes, funcname, outcomes=None, budget=None):
+    """
+    Evaluate a list of flagged volumes in a single invocation. Volumes are
+    grouped by region and described in bulk so API calls scale with the
+    number of regions rather than the number of volumes. If outcomes is
+    given it is filled with volume id -> summary key. If budget (the
+    API_CALLS count to stop at) is given, volumes are deferred once it is
+    reached.
+    volumes = [ { 'Volume ID': "", 'Region': "" } ]
+    """
+    if outcomes is None:
+        outcomes = {}
+    summary = { 'evaluated': 0, 'missing': 0, 'ignored': 0, 'snapshotted': 0, 'deferred': 0, 'failed': 0 }
+    byregion = {}
+    for vol in volumes:
+        reason = prefilter_volume(vol)
+        if reason:
+            print(f"Volume {vol.get('Volume ID')} in region {vol.get('Region')} {reason} and is ignored.")
+            summary['evaluated'] += 1
+            summary['ignored'] += 1
+            outcomes[vol.get('Volume ID')] = 'ignored'
+            continue
+        byregion.setdefault(vol['Region'], []).append(vol['Volume ID'])
+
+    with ThreadPoolExecutor(max_workers=CONFIG.REGIONWORKERS) as pool:
+        futures = {
+            region: pool.submit(sweep_region, region, list(dict.fromkeys(volids)), funcname, outcomes, budget)
+            for region, volids in byregion.items()
+        }
+    for region, future in futures.items():
+        try:
+            for key, count in future.result().items():
+                summary[key] += count
+        except Exception as e:
+            print(e)
+            print(f'ERROR: sweep of region {region} failed')
+            summary['failed'] += len(byregion[region])
+            outcomes.update((volid, 'failed') for volid in byregion[region])
+
+    print(f'Sweep complete: {json.dumps(summary)}')
+    return summary
+
+# ---------------------------------------------------------------------
+def sweep_region(region, volids, funcname, outcomes, budget=None):
+    """
+    Describe, filter and snapshot the flagged volumes of one region, in
+    order. At most REGIONCONCURRENCY snapshots are requested at once, and
+    volumes beyond the region's SnapshotScheduler slots are deferred, as
+    are the volumes left when the API call budget is reached.
+    Return summary counts for the region
+    """
+    summary = { 'evaluated': len(volids), 'missing': 0, 'ignored': 0, 'snapshotted': 0, 'deferred': 0, 'failed': 0 }
+
+    if not within_budget(budget):
+        print(f'{len(volids)} volumes in region {region} deferred: API call budget reached')
+        summary['deferred'] = len(volids)
+        outcomes.update((volid, 'deferred') for volid in volids)
+        return summary
+
+    # Nothing can be snapshotted while the region is at its snapshot limit
+    scheduler = snapshot_scheduler(region)
+    if not scheduler.available():
+        print(f'{len(volids)} volumes in region {region} deferred: {scheduler.limit} idle volume snapshots already in flight')
+        summary['deferred'] = len(volids)
+        outcomes.update((volid, 'deferred') for volid in volids)
+        return summary
+
+    volinfos = describe_volumes_batch(volids, region)
+    summary['missing'] = len(volids) - len(volinfos)
+    outcomes.update((volid, 'missing') for volid in volids if volid not in volinfos)
+
+    candidates = []
+    unevaluated = []
+    for volid in volids:
+        if volid not in volinfos:
+            continue
+        # Each evaluation may search CloudTrail, so stop once the budget is spent
+        if not within_budget(budget):
+            unevaluated.append(volid)
+            continue
+        reason = evaluate_volume(volinfos[volid], region)
+        if reason:
+            print(f'Volume {volid} in region {region} {reason} and is ignored.')
+            summary['ignored'] += 1
+            outcomes[volid] = 'ignored'
+        else:
+            candidates.append(volid)
+
+    # Each snapshot is one call, so only as many as the budget has left are taken
+    if budget:
+        remaining = max(budget - API_CALLS['count'], 0)
+        unevaluated += candidates[remaining:]
+        candidates = candidates[:remaining]
+
+    if unevaluated:
+        print(f'{len(unevaluated)} volumes in region {region} deferred: API call budget reached')
+        summary['deferred'] += len(unevaluated)
+        outcomes.update((volid, 'deferred') for volid in unevaluated)
+
+    if not candidates:
+        return summary
+
+    if region != MYREGION:
+        if not regionSetup(region, funcname):
+            print(f'ERROR: Could not set up cross-region support to {region}')
+            summary['failed'] += len(candidates)
+            outcomes.update((volid, 'failed') for volid in candidates)
+            return summary
+
+    admitted, deferred = [], []
+    for volid in candidates:
+        (admitted if scheduler.admit() else deferred).append(volid)
+    if deferred:
+        print(f'{len(deferred)} volumes in region {region} deferred: {scheduler.limit} idle volume snapshots already in flight')
+        summary['deferred'] += len(deferred)
+        outcomes.update((volid, 'deferred') for volid in deferred)
+
+    with ThreadPoolExecutor(max_workers=CONFIG.REGIONCONCURRENCY) as pool:
+        futures = { volid: pool.submit(snapshot_volume, volid, region) for volid in admitted }
+    for volid, future in futures.items():
+        try:
+            future.result()
+            print(f'snapshot initiated for {volid} in region {region}. Volume will be deleted when snapshot completes successfully.')
+            summary['snapshotted'] += 1
+            outcomes[volid] = 'snapshotted'
+        except Exception as e:
+            # Any error is this volume's alone, the other futures still report
+            scheduler.release()
+            if isinstance(e, ClientError) and e.response['Error']['Code'] == 'ConcurrentSnapshotLimitExceeded':
+                scheduler.full()
+                print(f'Volume {volid} in region {region} deferred: concurrent snapshot limit exceeded')
+                summary['deferred'] += 1
+                outcomes[volid] = 'deferred'
+                continue
+            print(e)
+            print(f'ERROR: could not snapshot {volid} in region {region}')
+            summary['failed'] += 1
+            outcomes[volid] = 'failed'
+
+    return summary
+
+# ---------------------------------------------------------------------
+@phase('queue')
+def write_candidates(puts=(), deletes=()):
+    """
+    Put and delete candidate table items in BatchWriteItem chunks, retrying
+    unprocessed items
+    """
+    dynamodb = connect('dynamodb')
+    requests = [{ 'PutRequest': { 'Item': item } } for item in puts]
+    requests += [{ 'DeleteRequest': { 'Key': key } } for key in deletes]
+
+    for i in range(0, len(requests), DYNAMODB_BATCH):
+        pending = { CONFIG.CANDIDATETABLE: requests[i:i + DYNAMODB_BATCH] }
+        for attempt in range(5):
+            pending = dynamodb.batch_write_item(RequestItems=pending).get('UnprocessedItems')
+            if not pending:
+                break
+            time.sleep(0.1 * 2 ** attempt)
+        else:
+            print(f'ERROR: {len(pending[CONFIG.CANDIDATETABLE])} candidate table writes were not processed')
+
+# ---------------------------------------------------------------------
+@phase('queue')
+def queued_priorities(volkeys):
+    """
+    Read the candidate index records of volumes in BatchGetItem chunks,
+    retrying unprocessed keys.
+    volkeys = [ "region#volume id" ]
+    return dict of region#volume id -> Priority of its queued candidate
+    """
+    dynamodb = connect('dynamodb')
+    queued = {}
+    for i in range(0, len(volkeys), DYNAMODB_GET_BATCH):
+        pending = { CONFIG.CANDIDATETABLE: { 'Keys': [
+            { 'Queue': { 'S': CANDIDATE_INDEX }, 'Priority': { 'S': volkey } }
+            for volkey in volkeys[i:i + DYNAMODB_GET_BATCH]
+        ] } }
+        for attempt in range(5):
+            response = dynamodb.batch_get_item(RequestItems=pending)
+            for item in response['Responses'].get(CONFIG.CANDIDATETABLE, []):
+                queued[item['Priority']['S']] = item['Queued']['S']
+            pending = response.get('UnprocessedKeys')
+            if not pending:
+                break
+            time.sleep(0.1 * 2 ** attempt)
+        else:
+            print(f'ERROR: {len(pending[CONFIG.CANDIDATETABLE]["Keys"])} candidate index reads were not processed')
+    return queued
+
+# ---------------------------------------------------------------------
+def enqueue_candidates(volumes):
+    """
+    Add flagged volumes to the candidate table. The sort key starts with the
+    monthly cost in cents so the most expensive volumes are drained first.
+    Each volume has one candidate: an index record per volume holds its
+    Priority, and a volume queued again at another cost replaces its
+    earlier candidate.
+    volumes = [ { 'Volume ID': "", 'Region': "", 'Monthly Storage Cost': "" } ]
+    Return the number of volumes queued
+    """
+    items = {}
+    for vol in volumes:
+        cost = monthly_cost(vol) or 0.0
+        priority = f"{int(round(cost * 100)):012d}#{vol['Region']}#{vol['Volume ID']}"
+        items[f"{vol['Region']}#{vol['Volume ID']}"] = {
+            'Queue': { 'S': CANDIDATE_QUEUE },
+            'Priority': { 'S': priority },
+            'VolumeId': { 'S': vol['Volume ID'] },
+            'Region': { 'S': vol['Region'] },
+            'MonthlyCost': { 'N': f'{cost:.2f}' },
+            'Queued': { 'S': datetime.utcnow().isoformat() }
+        }
+
+    queued = queued_priorities(list(items))
+    replaced = [
+        { 'Queue': { 'S': CANDIDATE_QUEUE }, 'Priority': { 'S': queued[volkey] } }
+        for volkey, item in items.items()
+        if volkey in queued and queued[volkey] != item['Priority']['S']
+    ]
+    index = [
+        { 'Queue': { 'S': CANDIDATE_INDEX }, 'Priority': { 'S': volkey }, 'Queued': item['Priority'] }
+        for volkey, item in items.items()
+    ]
+
+    write_candidates(puts=list(items.values()) + index, deletes=replaced)
+    return len(items)
+
+# ---------------------------------------------------------------------
+def dequeue_candidates(volumes):
+    """
+    Remove volumes handled outside a drain from the candidate table
+    volumes = [ { 'Volume ID': "", 'Region': "" } ]
+    """
+    volkeys = [f"{vol['Region']}#{vol['Volume ID']}" for vol in volumes]
+    queued = queued_priorities(volkeys)
+    write_candidates(deletes=[
+        { 'Queue': { 'S': CANDIDATE_QUEUE }, 'Priority': { 'S': priority } }
+        for priority in queued.values()
+    ] + [
+        { 'Queue': { 'S': CANDIDATE_INDEX }, 'Priority': { 'S': volkey } }
+        for volkey in queued
+    ])
+
+# ---------------------------------------------------------------------
+def drain_candidates(funcname, context=None):
+    """
+    Evaluate queued volumes most expensive first, DRAIN_BATCH at a time,
+    until the queue is empty, APIBUDGET calls have been made or the Lambda
+    is about to time out. Volumes that fail or are deferred by the
+    SnapshotScheduler stay queued for the next drain.
+    Return summary counts, the monthly cost of the volumes whose snapshots
+    were started (they are deleted when the snapshots complete) and that
+    cost per API call
+    """
+    dynamodb = connect('dynamodb')
+    budget = int(CONFIG.APIBUDGET or 0)
+    startcalls = API_CALLS['count']
+    summary = { 'evaluated': 0, 'missing': 0, 'ignored': 0, 'snapshotted': 0, 'deferred': 0, 'failed': 0, 'snapshotted_cost': 0.0 }
+
+    query = {
+        'TableName': CONFIG.CANDIDATETABLE,
+        'KeyConditionExpression': '#q = :q',
+        'ExpressionAttributeNames': { '#q': 'Queue' },
+        'ExpressionAttributeValues': { ':q': { 'S': CANDIDATE_QUEUE } },
+        'ScanIndexForward': False,
+        'Limit': DRAIN_BATCH
+    }
+    handled = set()
+    while True:
+        if budget and API_CALLS['count'] - startcalls >= budget:
+            print(f'API budget of {budget} calls reached. Remaining candidates are left for the next drain')
+            break
+        if context and context.get_remaining_time_in_millis() < DRAIN_MARGIN_MS:
+            print('Lambda is about to time out. Remaining candidates are left for the next drain')
+            break
+
+        response = dynamodb.query(**query)
+        items = response['Items']
+        if not items:
+            break
+
+        # A volume queued twice (before the candidate index) is handled once
+        duplicates, fresh = [], []
+        for item in items:
+            (duplicates if item['VolumeId']['S'] in handled else fresh).append(item)
+            handled.add(item['VolumeId']['S'])
+        items = fresh
+
+        costs = { item['VolumeId']['S']: float(item['MonthlyCost']['N']) for item in items }
+        volumes = [
+            { 'Volume ID': item['VolumeId']['S'], 'Region': item['Region']['S'], 'Monthly Storage Cost': item['MonthlyCost']['N'] }
+            for item in items
+        ]
+        outcomes = {}
+        for key, count in sweep_volumes(volumes, funcname, outcomes, startcalls + budget if budget else None).items():
+            summary[key] += count
+        summary['snapshotted_cost'] += sum(costs[volid] for volid, outcome in outcomes.items() if outcome == 'snapshotted')
+
+        done = [item for item in items if outcomes.get(item['VolumeId']['S']) not in ('failed', 'deferred')]
+        write_candidates(deletes=[
+            { 'Queue': item['Queue'], 'Priority': item['Priority'] }
+            for item in done + duplicates
+        ] + [
+            { 'Queue': { 'S': CANDIDATE_INDEX }, 'Priority': { 'S': f"{item['Region']['S']}#{item['VolumeId']['S']}" } }
+            for item in done
+        ])
+
+        if 'LastEvaluatedKey' not in response:
+            break
+        query['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    calls = API_CALLS['count'] - startcalls
+    summary['api_calls'] = calls
+    summary['snapshotted_cost'] = round(summary['snapshotted_cost'], 2)
+    summary['snapshotted_cost_per_api_call'] = round(summary['snapshotted_cost'] / calls, 4) if calls else 0.0
+    print(f'Drain complete: {json.dumps(summary)}')
+    return summary
+
+# ---------------------------------------------------------------------
+@phase('plan')
+def plan_volumes(volumes):
+    """
+    Run the read-side filters over flagged volumes without changing
+    anything, describing each region in bulk. The plan lists every volume
+    with its decision (delete, ignore, missing or error), the reason and
+    the monthly cost saved, and marks deletions not in the previous plan
+    as new. It is stored in STATEBUCKET under PLAN_PREFIX and as
+    PLAN_LATEST_KEY.
+    volumes = [ { 'Volume ID': "", 'Region': "", 'Monthly Storage Cost': "" } ]
+    Return the plan summary and key
+    """
+    entries = {}
+    byregion = {}
+    for vol in volumes:
+        volid = vol.get('Volume ID')
+        entries[volid] = {
+            'volume_id': volid,
+            'region': vol.get('Region'),
+            'decision': 'ignore',
+            'reason': prefilter_volume(vol),
+            'monthly_cost': monthly_cost(vol)
+        }
+        if not entries[volid]['reason']:
+            byregion.setdefault(vol['Region'], []).append(volid)
+
+    with ThreadPoolExecutor(max_workers=CONFIG.REGIONWORKERS) as pool:
+        futures = {
+            region: pool.submit(evaluate_region, region, list(dict.fromkeys(volids)))
+            for region, volids in byregion.items()
+        }
+    for region, future in futures.items():
+        try:
+            evaluated = future.result()
+        except Exception as e:
+            print(e)
+            print(f'ERROR: could not evaluate the volumes of region {region}')
+            for volid in byregion[region]:
+                entries[volid].update(decision='error', reason=str(e))
+            continue
+
+        for volid in byregion[region]:
+            entry = entries[volid]
+            if volid not in evaluated:
+                entry.update(decision='missing', reason='no longer exists')
+                continue
+            volinfo, reason = evaluated[volid]
+            entry['size_gib'] = volinfo.get('Size')
+            if reason:
+                entry['reason'] = reason
+            else:
+                entry.update(decision='delete', reason=f'has not been attached for {CONFIG.IDLETHRESH} days')
+
+    try:
+        previous = load_state(PLAN_LATEST_KEY) or { 'volumes': [] }
+    except ClientError as e:
+        print(e)
+        print('Could not read the previous plan. All deletions are marked new')
+        previous = { 'volumes': [] }
+    planned = { e['volume_id'] for e in previous['volumes'] if e['decision'] == 'delete' }
+    deletes = [entry for entry in entries.values() if entry['decision'] == 'delete']
+    for entry in deletes:
+        entry['new'] = entry['volume_id'] not in planned
+
+    created = datetime.utcnow()
+    summary = { decision: 0 for decision in ('delete', 'ignore', 'missing', 'error') }
+    for entry in entries.values():
+        summary[entry['decision']] += 1
+    summary['new'] = sum(1 for entry in deletes if entry['new'])
+    summary['monthly_savings'] = round(sum(entry['monthly_cost'] or 0.0 for entry in deletes), 2)
+
+    plan = {
+        'created': created.isoformat() + 'Z',
+        'account': CONFIG.account,
+        'idle_thresh': CONFIG.IDLETHRESH,
+        'summary': summary,
+        'volumes': sorted(entries.values(), key=lambda entry: -(entry['monthly_cost'] or 0.0))
+    }
+    if not CONFIG.STATEBUCKET:
+        print('WARNING: StateBucket is not set. The plan is returned but not stored')
+        return plan
+
+    key = f"{PLAN_PREFIX}{created.strftime('%Y%m%dT%H%M%SZ')}.json"
+    save_state(key, plan)
+    save_state(PLAN_LATEST_KEY, plan)
+    print(f'Plan {key}: {json.dumps(summary)}')
+    return dict(summary, plan=key)
+
+# ---------------------------------------------------------------------
+def execute_plan(key, volids, context):
+    """
+    Apply a stored plan (PLAN_LATEST_KEY if key is not given): snapshot and
+    delete its delete volumes, or only those in volids if given. Volumes
+    go through the filters again, so one that changed since the plan was
+    made is ignored. Only the approved volumes are swept, the candidate
+    queue is not drained, but their queued candidates are removed
+    """
+    key = key or PLAN_LATEST_KEY
+    plan = load_state(key)
+    if not plan:
+        print(f'ERROR: plan {key} not found in StateBucket')
+        return
+
+    approved = set(volids or [])
+    volumes = [
+        { 'Volume ID': entry['volume_id'], 'Region': entry['region'], 'Monthly Storage Cost': f"${entry['monthly_cost'] or 0:.2f}" }
+        for entry in plan['volumes']
+        if entry['decision'] == 'delete' and (not approved or entry['volume_id'] in approved)
+    ]
+    print(f"Executing plan {key} of {plan['created']}: {len(volumes)} volumes to snapshot and delete")
+    outcomes = {}
+    summary = sweep_volumes(volumes, context.function_name, outcomes)
+    if CONFIG.CANDIDATETABLE:
+        dequeue_candidates([
+            vol for vol in volumes if outcomes.get(vol['Volume ID']) not in ('failed', 'deferred')
+        ])
+    return summary
+
+# ---------------------------------------------------------------------
+def parse_snapshot_event(event):
+    """
+    Extract the ids from an EBS Snapshot Notification event
+    return { region: "", volid: "", snapshotid: "", result: "" } or None
+    """
+    region = event['region']
+    volarn = event['detail']['source']
+    snaparn = event['detail']['snapshot_id']
+
+    volsearch = re.match(".*:volume/(vol-.*)", volarn)
+    if not volsearch:
+        print(f'ERROR: could not find volume id from {volarn} in region {region}')
+        return None
+
+    snapsearch = re.match(".*:snapshot/(snap-.*)", snaparn)
+    if not snapsearch:
+        print(f'ERROR: could not find volume id from {snaparn} in region {region}')
+        return None
+
+    return {
+        'region': region,
+        'volid': volsearch.group(1),
+        'snapshotid': snapsearch.group(1),
+        'result': event['detail']['result']
+    }
+
+# ---------------------------------------------------------------------
+def complete_snapshot(volid, snapshotid, region, snapresult):
+    """
+    Delete the volume of one completed idle volume snapshot.
+    Return list of email addresses to notify, empty unless the volume was
+    deleted
+    """
+    print(f'region {region} volid {volid} snapshotid {snapshotid}')
+
+    # 1) is this one of ours?
+    if not has_tag(snapshotid, 'snapshot', region, 'SnapshotReason', 'Idle Volume'):
+        return [] # quietly disregard - this is not one of our snapshots
+
+    # 2) Validate successful snapshot
+    if snapresult != 'succeeded':
+        print(f'ERROR: snapshot {snapshotid} status is {snapresult} in region {region} - ignored.')
+        return []
+
+    # Read the owner before the volume is deleted
+    owner = CONFIG.MAILTOOWNER and hasowner(volid, region, CONFIG.MAILTOOWNER)
+
+    # 3) Is this a volume we care about? Get tags to make sure
+    deleted = False
+    if has_tag(snapshotid, 'snapshot', region, 'DeleteEBSVolOnCompletion'):
+        if bool(get_tag(snapshotid, 'snapshot', region, 'DeleteEBSVolOnCompletion')):
+            print(f'Deleting idle EBS volume {volid} in region {region}')
+            deleted = delete_volume(volid, region)
+        else:
+            print(f'Snapshot {snapshotid} did not specify deletion for this volume {volid} in region {region}')
+
+    # 4) the owner and MAILTO get the snapshot id and rehydration instructions,
+    # only for a volume that was really deleted
+    if not deleted:
+        return []
+    return [recipient for recipient in (owner, CONFIG.MAILTO) if recipient]
+
+# ---------------------------------------------------------------------
+def complete_snapshots(completions):
+    """
+    Delete the volumes of many completed snapshots in one pass. Snapshot and
+    volume tags are read from the region's tag index, snapshots newer than
+    the index are described in one batch, and each recipient gets a single
+    email covering all of their volumes. Snapshots of other tools (DLM, AWS
+    Backup) are remembered in FOREIGN_SNAPSHOTS and skipped.
+    completions = [ { region: "", volid: "", snapshotid: "", result: "" } ]
+    Return list of completions that could not be processed
+    """
+    byregion = {}
+    for completion in completions:
+        byregion.setdefault(completion['region'], []).append(completion)
+
+    failed = []
+    for region, items in byregion.items():
+        items = [c for c in items if c['snapshotid'] not in FOREIGN_SNAPSHOTS]
+        try:
+            # Snapshots newer than the cached index are missing from it - describe them
+            index = tag_index(region)
+            misses = [c['snapshotid'] for c in items if c['snapshotid'] not in index]
+            if misses:
+                described = describe_snapshots_batch(sorted(set(misses)), region)
+                for snapshotid in misses:
+                    if snapshotid not in described or not has_tag(snapshotid, 'snapshot', region, 'SnapshotReason', 'Idle Volume'):
+                        FOREIGN_SNAPSHOTS.add(snapshotid)
+                items = [c for c in items if c['snapshotid'] not in FOREIGN_SNAPSHOTS]
+        except ClientError as e:
+            print(e)
+            print(f'ERROR: could not read the tags of completed snapshots in region {region}')
+            failed.extend(items)
+            continue
+
+        for c in items:
+            try:
+                recipients = complete_snapshot(c['volid'], c['snapshotid'], region, c['result'])
+            except ClientError as e:
+                if e.response['Error']['Code'] == 'InvalidVolume.NotFound':
+                    print(f"Volume {c['volid']} in region {region} is already deleted")
+                    continue
+                print(e)
+                print(f"ERROR: could not complete snapshot {c['snapshotid']} in region {region}")
+                failed.append(c)
+                continue
+
+            for recipient in recipients:
+                queue_notification(
+                    recipient,
+                    { 'volid': c['volid'], 'snapshotid': c['snapshotid'], 'region': region }
+                )
+
+    # 5) email each recipient once with the snapshot ids and rehydration instructions
+    sent = send_notifications()
+    print(f'Sent {sent} notification emails for {len(completions)} completed snapshots')
+
+    return failed
+
+# ---------------------------------------------------------------------
+def complete_snapshot_messages(records):
+    """
+    Handle a batch of snapshot completion messages from SQS. The message
+    body is the EventBridge event, or an SNS notification wrapping it.
+    Return the messages to retry (ReportBatchItemFailures)
+    """
+    completions = []
+    for record in records:
+        try:
+            message = json.loads(record['body'])
+            if message.get('Type') == 'Notification':
+                message = json.loads(message['Message'])
+            completion = parse_snapshot_event(message)
+        except (ValueError, KeyError) as e:
+            print(e)
+            print(f"ERROR: could not parse message {record['messageId']} - ignored.")
+            continue
+
+        if completion:
+            completion['messageId'] = record['messageId']
+            completions.append(completion)
+
+    failed = complete_snapshots(completions)
+    print(f'Processed {len(records)} snapshot completion messages, {len(failed)} failed')
+
+    return { 'batchItemFailures': [ { 'itemIdentifier': c['messageId'] } for c in failed ] }
+
 # ---------------------------------------------------------------------
 def lambda_handler(event, context):
+    start = time.perf_counter()
+
+    # Resources are only cached for the life of one invocation
+    RESOURCES.clear()
+    API_CALLS['count'] = 0
+    CONFIG.set_account(event, context)
+
+    try:
+        return handle_event(event, context)
+    finally:
+        emit_metrics()
+        if STARTUP['cold']:
+            STARTUP['cold'] = False
+            STARTUP['first_invocation_ms'] = (time.perf_counter() - start) * 1000
+            print(f'Cold start: {json.dumps({ k: round(v, 2) if isinstance(v, float) else v for k, v in STARTUP.items() })}')
+
+# ---------------------------------------------------------------------
+def handle_event(event, context):
+
+    # Snapshot completions buffered in SQS are handled as one batch
+    if 'Records' in event and event['Records'][0].get('eventSource') == 'aws:sqs':
+        return complete_snapshot_messages(event['Records'])
 
     # Translate if from SNS
     if 'Records' in event:
         event = json.loads(event['Records'][0]['Sns']['Message'])
 
-    if event['source'] == 'aws.trustedadvisor':
-        volid = event['detail']['check-item-detail']['Volume ID']
-        region = event['detail']['check-item-detail']['Region']
+    # Sweep mode: evaluate a list of volumes, or the whole TA check result.
+    # With a candidate table they are queued and drained by cost instead
+    if event.get('source') in ('sweep', 'aws.events'):
+        return process_volumes(event.get('volumes') or get_flagged_volumes(), context)
 
-        cost = event['detail']['check-item-detail']['Monthly Storage Cost']
-        status = get_volume_status(volid, region)
-        volinfo = get_volume_info(volid, region)
+    if event.get('source') == 'drain':
+        return drain_candidates(context.function_name, context)
 
-        # 1) Ignore if volume has attachments
-        if len(volinfo['Attachments']) > 0:
-            print(f'Volume {volid} in region {region} has attachments and is ignored.')
-            return
+    # Plan mode: decide without changing anything, then apply a stored plan
+    if event.get('source') == 'plan':
+        return plan_volumes(event.get('volumes') or get_flagged_volumes())
+
+    if event.get('source') == 'execute':
+        return execute_plan(event.get('plan'), event.get('volumes'), context)
 
-        # 2) Ignore if volume is < IDLETHRESH days old
-        cdate = volinfo['CreateTime']
-        cdate = cdate.replace(tzinfo=None)
-        age = datetime.today() - cdate
-        if age.days < IDLETHRESH:
-            print(f'Volume {volid} in region {region} is {age.days} days old and is ignored. ( < IdleThresh )')
+    if event['source'] == 'aws.trustedadvisor':
+        volume = event['detail']['check-item-detail']
+        volid = volume.get('Volume ID')
+        region = volume.get('Region')
+
+        # 0) Payload, IgnoreVolumes and previously rejected volumes - no API calls
+        reason = prefilter_volume(volume)
+        if reason:
+            print(f'Volume {volid} in region {region} {reason} and is ignored.')
             return
 
-        # 3) Get tags - ignore if EXCEPTTAG tag present
-        if EXCEPTTAG and has_tag(volid, 'volume', region, EXCEPTTAG, EXCEPTTAGVAL):
-            print(f'Volume {volid} in region {region} has exception tag {EXCEPTTAG} and is ignored.')
+        # Queue by cost if there is a candidate table. The next drain handles it
+        if CONFIG.CANDIDATETABLE:
+            enqueue_candidates([volume])
+            print(f'Volume {volid} in region {region} queued for evaluation.')
             return
 
-        # 4) Get last mount and calculate idle days - ignore if below IDLETHRESH
-        if recentlyAttached(volid, region, IDLETHRESH):
-            print(f'volume {volid} in region {region} was recently attached to an instance and is ignored.')
+        # 1-4) Ignore attached, young, excepted and recently attached volumes
+        volinfo = get_volume_info(volid, region)
+        reason = evaluate_volume(volinfo, region)
+        if reason:
+            print(f'Volume {volid} in region {region} {reason} and is ignored.')
             return
 
         # 5) Snapshot and end. Snapshot event will redrive lambda
@@ -553,62 +2083,24 @@ def lambda_handler(event, context):
                 print(f'ERROR: Could not set up cross-region support to {region}')
                 return
 
-        snapshot_volume(volid, region)
+        scheduler = snapshot_scheduler(region)
+        if not scheduler.admit():
+            print(f'Volume {volid} in region {region} deferred to the next Trusted Advisor refresh: {scheduler.limit} idle volume snapshots already in flight')
+            return
+
+        try:
+            snapshot_volume(volid, region)
+        except Exception:
+            scheduler.release()
+            raise
         print(f'snapshot initiated for {volid} in region {region}. Volume will be deleted when snapshot completes successfully.')
         # Processing ends here and will resume off of the successful snapshot
 
     elif event['source'] == 'aws.ec2':
-        region = event['region']
-        volarn = event['detail']['source']
-        snaparn = event['detail']['snapshot_id']
-
-        volsearch = re.match(".*:volume/(vol-.*)", volarn)
-        volid = ''
-        if volsearch:
-            volid = volsearch.group(1)
-        else:
-            print(f'ERROR: could not find volume id from {volarn} in region {region}')
-            return
-
-        snapsearch = re.match(".*:snapshot/(snap-.*)", snaparn)
-        snapshotid = ''
-        if snapsearch:
-            snapshotid = snapsearch.group(1)
-        else:
-            print(f'ERROR: could not find volume id from {snaparn} in region {region}')
-            return
-
-        snapresult = event['detail']['result']
-
-        print(f'region {region} volid {volid} snapshotid {snapshotid}')
-
-        # 1) is this one of ours?
-        if not has_tag(snapshotid, 'snapshot', region, 'SnapshotReason', 'Idle Volume'):
-            return # quietly disregard - this is not one of our snapshots
-
-        # 2) Validate successful snapshot
-        if snapresult != 'succeeded':
-            print(f'ERROR: snapshot {snapshotid} status is {snapresult} in region {region} - ignored.')
-            return
-
-        # 3) Is this a volume we care about? Get tags to make sure
-        if has_tag(snapshotid, 'snapshot', region, 'DeleteEBSVolOnCompletion'):
-            if bool(get_tag(snapshotid, 'snapshot', region, 'DeleteEBSVolOnCompletion')):
-                print(f'Deleting idle EBS volume {volid} in region {region}')
-                delete_volume(volid, region)
-            else:
-                print(f'Snapshot {snapshotid} did not specify deletion for this volume {volid} in region {region}')
-
-        # 5) email the owner snapshot id and rehydration instructions
-        if MAILTOOWNER and hasowner(volid, region, MAILTOOWNER):
-            notify_owner(
-                hasowner(volid, region, MAILTOOWNER),
-                { 'volid': volid, 'snapshotid': snapshotid, 'region': region }
-            )
-        if MAILTO:
-            notify_owner(
-                MAILTO,
-                { 'volid': volid, 'snapshotid': snapshotid, 'region': region  }
-            )
+        completion = parse_snapshot_event(event)
+        if completion and complete_snapshots([completion]):
+            raise RuntimeError(f"Could not complete snapshot {completion['snapshotid']} in region {completion['region']}")
 
     return
+
+STARTUP['import_ms'] = (time.perf_counter() - INIT_START) * 1000
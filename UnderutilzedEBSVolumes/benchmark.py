@@ -0,0 +1,568 @@
+"""
+Copyright 2019. Amazon Web Services, Inc. All Rights Reserved.
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+# Offline benchmark for TAEBSVolDel. Fills an in-memory stand-in for the AWS
+# APIs the Lambda uses with N volumes across M regions (with synthetic
+# CloudTrail attach history and tags), replays Trusted Advisor and snapshot
+# complete events through lambda_handler, and reports API calls per volume,
+# wall time and peak memory. No AWS account or network access is needed.
+#
+#   python benchmark.py --volumes 800 --regions 17 --mode sweep
+#   python benchmark.py --volumes 200 --mode events --max-calls-per-volume 4
+#   python benchmark.py --volumes 2000 --mode queue --api-budget 500
+
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+import boto3
+import boto3.session
+from botocore.exceptions import ClientError
+
+ACCOUNT = '123456789012'
+HOME_REGION = 'us-east-1'
+FUNCTION_NAME = 'TAEBSVolumeSnapDelete'
+REGIONS = [
+    'us-east-1', 'us-east-2', 'us-west-1', 'us-west-2', 'ca-central-1',
+    'eu-west-1', 'eu-west-2', 'eu-west-3', 'eu-central-1', 'eu-north-1',
+    'ap-south-1', 'ap-northeast-1', 'ap-northeast-2', 'ap-southeast-1',
+    'ap-southeast-2', 'sa-east-1', 'me-south-1'
+]
+
+CALLS = Counter() # API calls made by the Lambda, keyed 'service.Operation'
+CALLS_LOCK = threading.Lock() # the Lambda calls from worker threads during a sweep
+
+#======================================================================
+#
+class StubAWS:
+    """
+    In-memory state shared by every stub client: volumes, snapshots and
+    CloudTrail events per region, plus S3 objects and emails sent
+    """
+    def __init__(self):
+        self.volumes = {}   # region -> volume id -> volume
+        self.snapshots = {} # region -> snapshot id -> snapshot
+        self.events = {}    # region -> list of CloudTrail events, most recent first
+        self.objects = {}   # S3 key -> body
+        self.rules = set()  # regions with the snapshot complete rule
+        self.candidates = {} # candidate table (partition key, sort key) -> item
+        self.emails = 0
+        self.completed = [] # snapshot complete events waiting to be delivered
+        self.snapids = itertools.count()
+
+    def error(self, code, operation):
+        return ClientError({ 'Error': { 'Code': code, 'Message': code } }, operation)
+
+STUB = StubAWS()
+
+# ---------------------------------------------------------------------
+class StubEvents:
+    """
+    Keeps handlers registered for every request of the client (such as the
+    API call counter and metrics). Service specific handlers such as the
+    rate limiters are dropped so the benchmark is not paced
+    """
+    def __init__(self):
+        self.handlers = {}
+
+    def register(self, eventname, handler, *args, **kwargs):
+        if '.' not in eventname:
+            self.handlers.setdefault(eventname, []).append(handler)
+
+    def emit(self, eventname, **kwargs):
+        for handler in self.handlers.get(eventname, []):
+            handler(**kwargs)
+
+    def register_first(self, *args, **kwargs):
+        pass
+
+# ---------------------------------------------------------------------
+class StubMeta:
+    def __init__(self, service):
+        self.events = StubEvents()
+        self.service_model = type('ServiceModel', (), { 'service_id': StubServiceId(service) })()
+
+class StubServiceId(str):
+    def hyphenize(self):
+        return str(self)
+
+# ---------------------------------------------------------------------
+class StubPaginator:
+    """
+    Follow NextToken through a stub operation the way a botocore paginator does
+    """
+    def __init__(self, operation):
+        self.operation = operation
+
+    def paginate(self, **kwargs):
+        while True:
+            page = self.operation(**kwargs)
+            yield page
+            if not page.get('NextToken'):
+                return
+            kwargs['NextToken'] = page['NextToken']
+
+# ---------------------------------------------------------------------
+class StubClient:
+    """
+    Stand-in for a boto3 client. Operations are looked up on the class as
+    <service>_<operation>; any other operation is counted and returns {}
+    """
+    def __init__(self, service, region):
+        self.service = service
+        self.region = region
+        self.meta = StubMeta(service)
+
+    def get_paginator(self, operation):
+        return StubPaginator(getattr(self, operation))
+
+    def __getattr__(self, operation):
+        handler = getattr(type(self), f'{self.service}_{operation}', None)
+
+        def call(**kwargs):
+            name = ''.join(word.capitalize() for word in operation.split('_'))
+            with CALLS_LOCK:
+                CALLS[f'{self.service}.{name}'] += 1
+            context = {}
+            events = self.meta.events
+            events.emit('before-call', context=context)
+            events.emit('before-send', request=None)
+            try:
+                response = handler(self, **kwargs) if handler else {}
+            except ClientError as e:
+                events.emit('after-call-error', exception=e, context=context)
+                raise
+            events.emit('after-call', context=context)
+            return response
+
+        return call
+
+    # --- ec2 ---
+    def ec2_describe_volumes(self, VolumeIds=None, Filters=None, **kwargs):
+        volumes = STUB.volumes.setdefault(self.region, {})
+        if VolumeIds:
+            missing = [volid for volid in VolumeIds if volid not in volumes]
+            if missing:
+                raise STUB.error('InvalidVolume.NotFound', 'DescribeVolumes')
+            return { 'Volumes': [volumes[volid] for volid in VolumeIds] }
+        wanted = Filters[0]['Values'] if Filters else list(volumes)
+        return { 'Volumes': [volumes[volid] for volid in wanted if volid in volumes] }
+
+    def ec2_describe_snapshots(self, SnapshotIds=None, Filters=None, **kwargs):
+        snapshots = STUB.snapshots.setdefault(self.region, {})
+        if SnapshotIds:
+            return { 'Snapshots': [snapshots[snapid] for snapid in SnapshotIds if snapid in snapshots] }
+        found = list(snapshots.values())
+        for f in Filters or []:
+            if f['Name'] == 'snapshot-id':
+                found = [snap for snap in found if snap['SnapshotId'] in f['Values']]
+            elif f['Name'] == 'status':
+                found = [snap for snap in found if snap['State'] in f['Values']]
+            elif f['Name'].startswith('tag:'):
+                key = f['Name'][4:]
+                found = [snap for snap in found if any(t['Key'] == key and t['Value'] in f['Values'] for t in snap['Tags'])]
+        return { 'Snapshots': found }
+
+    def ec2_describe_tags(self, Filters=None, NextToken=None, MaxResults=1000, **kwargs):
+        keys = types = None
+        for f in Filters or []:
+            if f['Name'] == 'key':
+                keys = f['Values']
+            elif f['Name'] == 'resource-type':
+                types = f['Values']
+        resources = []
+        if types is None or 'volume' in types:
+            resources += [(volid, 'volume', vol['Tags']) for volid, vol in STUB.volumes.get(self.region, {}).items()]
+        if types is None or 'snapshot' in types:
+            resources += [(snapid, 'snapshot', snap['Tags']) for snapid, snap in STUB.snapshots.get(self.region, {}).items()]
+        matched = [
+            { 'ResourceId': resid, 'ResourceType': restype, 'Key': tag['Key'], 'Value': tag['Value'] }
+            for resid, restype, tags in resources for tag in tags if keys is None or tag['Key'] in keys
+        ]
+        offset = int(NextToken or 0)
+        response = { 'Tags': matched[offset:offset + MaxResults] }
+        if offset + MaxResults < len(matched):
+            response['NextToken'] = str(offset + MaxResults)
+        return response
+
+    def ec2_create_snapshot(self, VolumeId, TagSpecifications=None, **kwargs):
+        snapid = f'snap-{next(STUB.snapids):017x}'
+        tags = TagSpecifications[0]['Tags'] if TagSpecifications else []
+        STUB.snapshots.setdefault(self.region, {})[snapid] = {
+            'SnapshotId': snapid,
+            'VolumeId': VolumeId,
+            'State': 'pending',
+            'Tags': tags
+        }
+        STUB.completed.append({
+            'source': 'aws.ec2',
+            'account': ACCOUNT,
+            'region': self.region,
+            'detail-type': 'EBS Snapshot Notification',
+            'detail': {
+                'event': 'createSnapshot',
+                'result': 'succeeded',
+                'snapshot_id': f'arn:aws:ec2::{self.region}:snapshot/{snapid}',
+                'source': f'arn:aws:ec2::{self.region}:volume/{VolumeId}'
+            }
+        })
+        return { 'SnapshotId': snapid, 'State': 'pending' }
+
+    def ec2_delete_volume(self, VolumeId, DryRun=False, **kwargs):
+        if DryRun:
+            raise STUB.error('DryRunOperation', 'DeleteVolume')
+        STUB.volumes[self.region].pop(VolumeId, None)
+        return {}
+
+    # --- cloudtrail ---
+    def cloudtrail_lookup_events(self, LookupAttributes, StartTime, EndTime, NextToken=None, MaxResults=50, **kwargs):
+        key = LookupAttributes[0]['AttributeKey']
+        value = LookupAttributes[0]['AttributeValue']
+        start = StartTime.replace(tzinfo=timezone.utc)
+        end = EndTime.replace(tzinfo=timezone.utc)
+        matched = [
+            event for event in STUB.events.get(self.region, [])
+            if start <= event['EventTime'] <= end and (
+                (key == 'EventName' and event['EventName'] == value) or
+                (key == 'ResourceName' and any(r['ResourceName'] == value for r in event['Resources']))
+            )
+        ]
+        offset = int(NextToken or 0)
+        response = { 'Events': matched[offset:offset + MaxResults] }
+        if offset + MaxResults < len(matched):
+            response['NextToken'] = str(offset + MaxResults)
+        return response
+
+    # --- s3 ---
+    def s3_get_object(self, Bucket, Key, **kwargs):
+        if Key not in STUB.objects:
+            raise STUB.error('NoSuchKey', 'GetObject')
+        return { 'Body': io.BytesIO(STUB.objects[Key]) }
+
+    def s3_put_object(self, Bucket, Key, Body, **kwargs):
+        STUB.objects[Key] = Body.encode() if isinstance(Body, str) else Body
+        return {}
+
+    # --- dynamodb ---
+    def dynamodb_batch_write_item(self, RequestItems, **kwargs):
+        for requests in RequestItems.values():
+            for request in requests:
+                if 'PutRequest' in request:
+                    item = request['PutRequest']['Item']
+                    STUB.candidates[(item['Queue']['S'], item['Priority']['S'])] = item
+                else:
+                    key = request['DeleteRequest']['Key']
+                    STUB.candidates.pop((key['Queue']['S'], key['Priority']['S']), None)
+        return { 'UnprocessedItems': {} }
+
+    def dynamodb_batch_get_item(self, RequestItems, **kwargs):
+        return { 'Responses': {
+            table: [
+                STUB.candidates[(key['Queue']['S'], key['Priority']['S'])]
+                for key in request['Keys'] if (key['Queue']['S'], key['Priority']['S']) in STUB.candidates
+            ]
+            for table, request in RequestItems.items()
+        }, 'UnprocessedKeys': {} }
+
+    def dynamodb_query(self, Limit, ExpressionAttributeValues, ExclusiveStartKey=None, **kwargs):
+        queue = ExpressionAttributeValues[':q']['S']
+        keys = sorted((key for q, key in STUB.candidates if q == queue), reverse=True)
+        if ExclusiveStartKey:
+            keys = [key for key in keys if key < ExclusiveStartKey['Priority']['S']]
+        response = { 'Items': [STUB.candidates[(queue, key)] for key in keys[:Limit]] }
+        if len(keys) > Limit:
+            response['LastEvaluatedKey'] = { 'Priority': { 'S': keys[Limit - 1] } }
+        return response
+
+    # --- sns / events / lambda / ses / sts ---
+    def sns_create_topic(self, Name, **kwargs):
+        return { 'TopicArn': f'arn:aws:sns:{self.region}:{ACCOUNT}:{Name}' }
+
+    def sns_list_subscriptions_by_topic(self, **kwargs):
+        return { 'Subscriptions': [] }
+
+    def events_describe_rule(self, Name, **kwargs):
+        if self.region not in STUB.rules:
+            raise STUB.error('ResourceNotFoundException', 'DescribeRule')
+        return { 'Name': Name }
+
+    def events_put_rule(self, **kwargs):
+        STUB.rules.add(self.region)
+        return {}
+
+    def ses_send_email(self, **kwargs):
+        STUB.emails += 1
+        return { 'MessageId': str(STUB.emails) }
+
+    def sts_get_caller_identity(self, **kwargs):
+        return { 'Account': ACCOUNT }
+
+# ---------------------------------------------------------------------
+class StubSession:
+    """
+    Stand-in for boto3.session.Session handing out stub clients
+    """
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def client(self, service, region_name=None, **kwargs):
+        return StubClient(service, region_name)
+
+# ---------------------------------------------------------------------
+class StubContext:
+    function_name = FUNCTION_NAME
+    invoked_function_arn = f'arn:aws:lambda:{HOME_REGION}:{ACCOUNT}:function:{FUNCTION_NAME}'
+
+    def get_remaining_time_in_millis(self):
+        return 900000
+
+# ---------------------------------------------------------------------
+class Tee(io.StringIO):
+    """
+    Captures the Lambda output and also shows it
+    """
+    def write(self, text):
+        sys.__stdout__.write(text)
+        return super().write(text)
+
+#======================================================================
+#
+def populate(nvolumes, nregions, attached, recent, tagged, seed):
+    """
+    Create nvolumes volumes spread across nregions regions. A fraction are
+    attached, recently attached (CloudTrail history within 30 days), or
+    carry the exception tag. Every volume has an Owner tag.
+    Return list of check-item-detail style dicts for the volumes
+    """
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    flagged = []
+    for i in range(nvolumes):
+        region = REGIONS[i % nregions]
+        volid = f'vol-{i:017x}'
+        tags = [{ 'Key': 'Owner', 'Value': f'owner{i % 25}@example.com' }]
+        if rng.random() < tagged:
+            tags.append({ 'Key': 'ignoreEBSidle', 'Value': 'False' })
+        STUB.volumes.setdefault(region, {})[volid] = {
+            'VolumeId': volid,
+            'Size': 100,
+            'CreateTime': now - timedelta(days=rng.randint(100, 400)),
+            'Attachments': [{ 'InstanceId': 'i-0' }] if rng.random() < attached else [],
+            'Tags': tags
+        }
+
+        # Old attach/detach noise plus recent activity for some volumes
+        history = STUB.events.setdefault(region, [])
+        for eventname, days in (('AttachVolume', 200), ('DetachVolume', 95)):
+            history.append(cloudtrail_event(eventname, volid, now - timedelta(days=days)))
+        if rng.random() < recent:
+            history.append(cloudtrail_event('DetachVolume', volid, now - timedelta(days=rng.randint(1, 30))))
+
+        flagged.append({
+            'Volume ID': volid,
+            'Region': region,
+            'Monthly Storage Cost': f'${rng.uniform(1, 500):.2f}'
+        })
+
+    for history in STUB.events.values():
+        history.sort(key=lambda event: event['EventTime'], reverse=True)
+
+    return flagged
+
+# ---------------------------------------------------------------------
+def cloudtrail_event(eventname, volid, eventtime):
+    return {
+        'EventName': eventname,
+        'EventTime': eventtime,
+        'Resources': [
+            { 'ResourceType': 'AWS::EC2::Volume', 'ResourceName': volid },
+            { 'ResourceType': 'AWS::EC2::Instance', 'ResourceName': 'i-0' }
+        ]
+    }
+
+# ---------------------------------------------------------------------
+def ta_event(volume):
+    return {
+        'source': 'aws.trustedadvisor',
+        'account': ACCOUNT,
+        'region': HOME_REGION,
+        'detail-type': 'Trusted Advisor Check Item Refresh Notification',
+        'detail': {
+            'check-name': 'Underutilized Amazon EBS Volumes',
+            'check-item-detail': dict(volume, **{ 'Volume Type': 'General purpose(SSD)', 'Volume Size': '100' }),
+            'status': 'WARN'
+        }
+    }
+
+# ---------------------------------------------------------------------
+def replay(handler, flagged, mode, batchsize, drains):
+    """
+    Replay the Trusted Advisor findings, then the snapshot complete events
+    they cause, through the Lambda handler. In queue mode the findings are
+    queued in the candidate table and drained by up to drains invocations,
+    with the snapshots of each drain completing before the next. In plan
+    mode a plan is made from the findings and then executed.
+    Return the number of snapshots and the drain or plan summaries
+    """
+    context = StubContext()
+    summaries = []
+    snapshots = 0
+    if mode == 'sweep':
+        handler({ 'source': 'sweep', 'volumes': flagged }, context)
+    elif mode == 'plan':
+        summaries.append(handler({ 'source': 'plan', 'volumes': flagged }, context))
+        handler({ 'source': 'execute' }, context)
+    else:
+        for volume in flagged:
+            handler(ta_event(volume), context)
+    if mode == 'queue':
+        queue = sys.modules['TAEBSVolDel'].CANDIDATE_QUEUE
+        while any(q == queue for q, key in STUB.candidates) and len(summaries) < drains:
+            summaries.append(handler({ 'source': 'drain' }, context))
+            snapshots += complete(handler, context, mode, batchsize)
+            sys.modules['TAEBSVolDel'].SCHEDULERS.clear() # drains are an hour apart, so pending counts are stale
+
+    return snapshots + complete(handler, context, mode, batchsize), summaries
+
+# ---------------------------------------------------------------------
+def complete(handler, context, mode, batchsize):
+    """
+    Complete the pending snapshots and deliver their events, in SQS batches
+    or one SNS event at a time. Return the number delivered
+    """
+    completed, STUB.completed = STUB.completed, []
+    for snapshots in STUB.snapshots.values():
+        for snapshot in snapshots.values():
+            snapshot['State'] = 'completed'
+
+    if mode in ('sweep', 'queue', 'plan'):
+        for i in range(0, len(completed), batchsize):
+            records = [
+                { 'eventSource': 'aws:sqs', 'messageId': str(i + n), 'body': json.dumps(event) }
+                for n, event in enumerate(completed[i:i + batchsize])
+            ]
+            handler({ 'Records': records }, context)
+    else:
+        for event in completed:
+            handler({ 'Records': [{ 'Sns': { 'Message': json.dumps(event) } }] }, context)
+
+    return len(completed)
+
+# ---------------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark for the TAEBSVolDel idle EBS volume pipeline')
+    parser.add_argument('--volumes', type=int, default=500, help='number of flagged volumes')
+    parser.add_argument('--regions', type=int, default=4, choices=range(1, len(REGIONS) + 1), metavar=f'1-{len(REGIONS)}', help='number of regions')
+    parser.add_argument('--mode', choices=['sweep', 'events', 'queue', 'plan'], default='sweep', help='one sweep and SQS batches, one event per volume, events queued by cost and drained, or a plan then its execution')
+    parser.add_argument('--api-budget', type=int, default=0, help='API calls per drain (queue mode, 0 for no limit)')
+    parser.add_argument('--drains', type=int, default=10, help='max drain invocations (queue mode)')
+    parser.add_argument('--snapshot-concurrency', type=int, default=50, help='idle volume snapshots allowed in flight per region')
+    parser.add_argument('--batch-size', type=int, default=1000, help='SQS batch size for snapshot completions (sweep mode)')
+    parser.add_argument('--attached', type=float, default=0.1, help='fraction of volumes currently attached')
+    parser.add_argument('--recent', type=float, default=0.2, help='fraction of volumes attached within the threshold')
+    parser.add_argument('--tagged', type=float, default=0.05, help='fraction of volumes with the exception tag')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--max-calls-per-volume', type=float, help='exit non-zero if API calls per volume exceed this')
+    parser.add_argument('--verbose', action='store_true', help='show the Lambda output')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+
+    os.environ.setdefault('AWS_REGION', HOME_REGION)
+    os.environ.setdefault('StateBucket', 'benchmark-state')
+    os.environ.setdefault('EnableActions', 'True') # the stub deletes, so the notification path is measured too
+    os.environ['SnapshotConcurrency'] = str(args.snapshot_concurrency)
+    if args.mode == 'queue':
+        os.environ['CandidateTable'] = 'benchmark-candidates'
+        os.environ['ApiBudget'] = str(args.api_budget)
+    boto3.session.Session = StubSession
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    flagged = populate(args.volumes, args.regions, args.attached, args.recent, args.tagged, args.seed)
+
+    output = Tee() if args.verbose else io.StringIO()
+    tracemalloc.start()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(output):
+        import TAEBSVolDel
+        snapshots, summaries = replay(TAEBSVolDel.lambda_handler, flagged, args.mode, args.batch_size, args.drains)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    # Per phase totals from the Lambda's embedded metrics
+    phases = {}
+    for line in output.getvalue().splitlines():
+        if line.startswith('{"_aws"'):
+            metric = json.loads(line)
+            totals = phases.setdefault(metric['Phase'], Counter())
+            totals.update({ name: metric[name] for name in ('Count', 'Duration', 'Calls', 'Throttles') })
+
+    total = sum(CALLS.values())
+    report = {
+        'mode': args.mode,
+        'volumes': args.volumes,
+        'regions': args.regions,
+        'snapshots': snapshots,
+        'emails': STUB.emails,
+        'api_calls': total,
+        'api_calls_per_volume': round(total / max(args.volumes, 1), 3),
+        'wall_time_sec': round(elapsed, 3),
+        'peak_memory_mb': round(peak / 1048576, 2),
+        'drains': [
+            { key: drain[key] for key in ('snapshotted', 'snapshotted_cost', 'api_calls', 'snapshotted_cost_per_api_call') }
+            for drain in summaries if args.mode == 'queue'
+        ],
+        'plan': summaries[0] if args.mode == 'plan' else None,
+        'phases': {
+            name: { 'count': totals['Count'], 'duration_ms': round(totals['Duration'], 1), 'calls': totals['Calls'], 'throttles': totals['Throttles'] }
+            for name, totals in sorted(phases.items())
+        },
+        'calls': dict(CALLS.most_common())
+    }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for key, value in report.items():
+            if key == 'drains':
+                for n, drain in enumerate(value, 1):
+                    print(f'{"drain " + str(n):<22} {json.dumps(drain)}')
+            elif key == 'plan':
+                if value:
+                    print(f'{key:<22} {json.dumps(value)}')
+            elif key not in ('phases', 'calls'):
+                print(f'{key:<22} {value}')
+        print('')
+        print(f'  {"phase":<22} {"count":>8} {"duration ms":>12} {"calls":>8} {"throttles":>10}')
+        for name, totals in report['phases'].items():
+            print(f"  {name:<22} {totals['count']:>8} {totals['duration_ms']:>12} {totals['calls']:>8} {totals['throttles']:>10}")
+        print('')
+        for name, count in CALLS.most_common():
+            print(f'  {name:<40} {count:>8}')
+
+    if args.max_calls_per_volume is not None and report['api_calls_per_volume'] > args.max_calls_per_volume:
+        print(f"FAIL: {report['api_calls_per_volume']} API calls per volume exceeds {args.max_calls_per_volume}")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()